@@ -1,14 +1,32 @@
-from typing import TYPE_CHECKING, Any
+import asyncio
+import logging
+import re
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, ClassVar, cast
 
-import anthropic
-from anthropic.types import Message
+import httpx
 
 if TYPE_CHECKING:
-    from search_tools import ToolManager
+    import anthropic
+    from anthropic.types import Message, TextBlock
+    from search_tools import SearchContext, ToolManager, ToolResult
 
+logger = logging.getLogger(__name__)
 
-class AIGenerator:
-    """Handles interactions with Anthropic's Claude API for generating responses"""
+# SessionManager writes history as "Role: content" lines; split before each
+# user turn so every exchange becomes its own content block
+_EXCHANGE_BOUNDARY = re.compile(r"\n(?=User: )")
+
+
+def _message(role: str, content: Any) -> dict[str, Any]:
+    """Build one conversation message for the messages API"""
+    return {"role": role, "content": content}
+
+
+class BaseAIGenerator(ABC):
+    """Shared prompt, request building and message bookkeeping for Claude"""
 
     # Static system prompt to avoid rebuilding on each call
     SYSTEM_PROMPT = """ You are an AI assistant specialized in course materials and educational content with access to tools for course information.
@@ -19,6 +37,8 @@ Available Tools:
 2. **get_course_outline**: Get complete course structure with all lessons
    - Use for questions about course structure, table of contents, lesson lists, or what a course covers
    - Returns: course title, course link, and all lessons with their numbers, titles, and links
+3. **batch_tool**: Run several of the tools above at once in a single call
+   - Use whenever a question needs more than one independent lookup, instead of separate tool calls
 
 Tool Usage Guidelines:
 - **Sequential tool use**: You can make up to 2 tool calls across sequential rounds if needed for complex queries
@@ -26,7 +46,7 @@ Tool Usage Guidelines:
 - Use **search_course_content** for: specific topics, concepts, code examples, or detailed explanations
 - **Multi-step examples**:
   - "What lessons are in MCP course and what does lesson 2 cover?" → get outline, then search lesson 2
-  - "Compare prompt engineering in lesson 1 vs lesson 3" → search lesson 1, then search lesson 3
+  - "Compare prompt engineering in lesson 1 vs lesson 3" → one batch_tool call searching lesson 1 and lesson 3
 - If no results, state this clearly without offering alternatives
 
 Response Protocol:
@@ -47,48 +67,259 @@ Provide only the direct answer to what was asked.
     # Maximum sequential tool-calling rounds per query
     MAX_TOOL_ROUNDS = 2
 
+    # Marks the end of a request prefix that Anthropic may cache server-side
+    CACHE_CONTROL: ClassVar[dict[str, str]] = {"type": "ephemeral"}
+
+    # Shared tool_choice values; the SDK only reads them
+    TOOL_CHOICE_AUTO: ClassVar[dict[str, str]] = {"type": "auto"}
+    TOOL_CHOICE_NONE: ClassVar[dict[str, str]] = {"type": "none"}
+
+    # System blocks are static, so build them once and share across calls
+    SYSTEM_CONTENT: ClassVar[list[dict[str, Any]]] = [
+        {"type": "text", "text": SYSTEM_PROMPT, "cache_control": CACHE_CONTROL}
+    ]
+
+    # Returned when Claude asks for a tool but no tool manager was given
+    NO_TOOL_MANAGER_ERROR = (
+        "Error: Tool execution requested but no tool manager available"
+    )
+
+    # Token-efficient tool use is a beta only on Claude 3.7 Sonnet models
+    EFFICIENT_TOOLS_BETA = "token-efficient-tools-2025-02-19"
+
     def __init__(self, api_key: str, model: str) -> None:
-        self.client = anthropic.Anthropic(api_key=api_key)
+        self.client = self._create_client(
+            api_key, {"anthropic-beta": self._build_beta_header(model)}
+        )
         self.model = model
 
         # Pre-build base API parameters
         self.base_params = {"model": self.model, "temperature": 0, "max_tokens": 800}
 
-    def _execute_all_tools(
-        self, response: Message, tool_manager: "ToolManager"
+        # Last (tools, cacheable copy) pair; ToolManager hands out the same
+        # list until a tool is registered, so the copy is reused across queries
+        self._cached_tools_memo: tuple[list | None, list] = (None, [])
+
+    @abstractmethod
+    def _create_client(self, api_key: str, default_headers: dict[str, str]) -> Any:
+        """Create the Anthropic client used for API calls"""
+
+    def _build_beta_header(self, model: str) -> str:
+        """Build the anthropic-beta header value for the given model"""
+        betas = ["prompt-caching-2024-07-31"]
+        if "3-7" in model:
+            betas.append(self.EFFICIENT_TOOLS_BETA)
+        return ",".join(betas)
+
+    def _build_initial_messages(
+        self, query: str, conversation_history: str | None
     ) -> list[dict[str, Any]]:
         """
-        Execute all tool calls from a response and return formatted results.
+        Build the opening user turn, placing history ahead of the query.
+
+        History lives in messages rather than the system prompt so the cached
+        tools and system prefix stay byte-identical across turns. Each
+        exchange is its own block and the last one ends a cacheable prefix;
+        the next turn only appends an exchange, so it reads the earlier ones
+        from the cache until SessionManager trims the history.
 
         Args:
-            response: API response containing tool_use blocks
-            tool_manager: Manager to execute tools
+            query: The user's question or request
+            conversation_history: Previous messages for context
 
         Returns:
-            List of tool_result dictionaries
+            Initial messages list for the tool loop
         """
-        tool_results = []
+        if not conversation_history:
+            return [_message("user", query)]
+
+        first, *rest = _EXCHANGE_BOUNDARY.split(conversation_history)
+        history_blocks = [
+            {"type": "text", "text": text}
+            for text in (f"Previous conversation:\n{first}", *rest)
+        ]
+        history_blocks[-1]["cache_control"] = self.CACHE_CONTROL
+
+        return [_message("user", [*history_blocks, {"type": "text", "text": query}])]
+
+    def _build_cached_tools(self, tools: list) -> list:
+        """Return a copy of tools with the last definition marked cacheable"""
+        source, cached_tools = self._cached_tools_memo
+        if source is not tools:
+            cached_tools = [
+                *tools[:-1],
+                {**tools[-1], "cache_control": self.CACHE_CONTROL},
+            ]
+            # Swap both halves at once so concurrent queries never mix them
+            self._cached_tools_memo = (tools, cached_tools)
+        return cached_tools
+
+    def _build_api_params(
+        self, messages: list[dict[str, Any]], cached_tools: list | None
+    ) -> dict[str, Any]:
+        """Build messages.create parameters shared by every round of the tool loop"""
+        # Reference the live messages list; rounds append to it in place and
+        # the SDK never mutates it, so there is nothing to copy per call
+        api_params = {
+            **self.base_params,
+            "messages": messages,
+            "system": self.SYSTEM_CONTENT,
+        }
 
-        for content_block in response.content:
-            if content_block.type == "tool_use":
-                # Execute tool
-                result = tool_manager.execute_tool(
-                    content_block.name, **content_block.input
-                )
+        # Add tools if available
+        if cached_tools:
+            api_params["tools"] = cached_tools
+            api_params["tool_choice"] = self.TOOL_CHOICE_AUTO
+
+        return api_params
+
+    def _enter_final_round(self, api_params: dict[str, Any]) -> None:
+        """Forbid further tool use while keeping the cached tool definitions"""
+        if "tools" in api_params:
+            api_params["tool_choice"] = self.TOOL_CHOICE_NONE
+
+    def _format_tool_result(
+        self, tool_use_id: str, result: "ToolResult"
+    ) -> dict[str, Any]:
+        """Format a tool's output as a tool_result content block"""
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "content": result.content,
+            "is_error": result.is_error,
+        }
 
-                # Check if result indicates error
-                is_error = result.startswith(("Error:", "Tool '"))
+    def _run_tool(
+        self,
+        block: Any,
+        tool_manager: "ToolManager",
+        context: "SearchContext | None",
+    ) -> "ToolResult | Exception":
+        """Run one tool_use block, returning rather than raising its exception"""
+        outcome: ToolResult | Exception
+        try:
+            outcome = tool_manager.execute_tool(
+                block.name, context=context, **block.input
+            )
+        except Exception as e:
+            logger.error("Tool %s failed: %s", block.name, e)
+            outcome = e
+
+        if isinstance(outcome, Exception) or outcome.is_error:
+            self._mark_failed(context)
+        return outcome
+
+    def _mark_failed(self, context: "SearchContext | None") -> None:
+        """Flag a request whose answer was built without working tools"""
+        if context is not None:
+            context.failed = True
+
+    def _cancel_tools(self, context: "SearchContext | None") -> None:
+        """Flag a request whose tools that have not started should not run"""
+        if context is not None:
+            context.cancelled = True
+
+    def _format_tool_results(
+        self, tool_blocks: list[Any], outcomes: "list[ToolResult | Exception]"
+    ) -> tuple[list[dict[str, Any]], bool]:
+        """
+        Format one tool_result per tool_use block, in tool_use order.
+
+        Every block must be answered or the next call is rejected, so a tool
+        that raised is reported as an error result rather than dropped.
 
+        Returns:
+            Tuple of (tool_result dictionaries, whether any tool raised)
+        """
+        tool_results = []
+        failed = False
+        for block, outcome in zip(tool_blocks, outcomes, strict=True):
+            if isinstance(outcome, Exception):
+                failed = True
                 tool_results.append(
                     {
                         "type": "tool_result",
-                        "tool_use_id": content_block.id,
-                        "content": result,
-                        "is_error": is_error,
+                        "tool_use_id": block.id,
+                        "content": f"Tool execution failed: {outcome!s}",
+                        "is_error": True,
                     }
                 )
+            else:
+                tool_results.append(self._format_tool_result(block.id, outcome))
+        return tool_results, failed
+
+    def _append_tool_round(
+        self,
+        messages: list[dict[str, Any]],
+        response: "Message",
+        tool_results: list[dict[str, Any]],
+        round_count: int,
+    ) -> None:
+        """Record a completed tool round in the message history"""
+        # Add assistant's tool use to messages
+        messages.append(_message("assistant", response.content))
+
+        # Add tool results to messages
+        if tool_results:
+            # Cache the first round so later rounds reuse the prefix
+            if round_count == 0:
+                tool_results[-1]["cache_control"] = self.CACHE_CONTROL
+            messages.append(_message("user", tool_results))
+
+
+class AIGenerator(BaseAIGenerator):
+    """Handles interactions with Anthropic's Claude API for generating responses"""
+
+    # Worker threads for running parallel tool_use blocks at once
+    MAX_PARALLEL_TOOLS = 4
+
+    def __init__(self, api_key: str, model: str) -> None:
+        super().__init__(api_key, model)
+        self._tool_executor = ThreadPoolExecutor(
+            max_workers=self.MAX_PARALLEL_TOOLS, thread_name_prefix="tool"
+        )
+
+    def _create_client(
+        self, api_key: str, default_headers: dict[str, str]
+    ) -> "anthropic.Anthropic":
+        """Create a blocking Anthropic client"""
+        import anthropic  # Deferred: the SDK is slow to import
+
+        return anthropic.Anthropic(api_key=api_key, default_headers=default_headers)
 
-        return tool_results
+    def _execute_all_tools(
+        self,
+        response: "Message",
+        tool_manager: "ToolManager",
+        context: "SearchContext | None" = None,
+    ) -> tuple[list[dict[str, Any]], bool]:
+        """
+        Execute all tool calls from a response and return formatted results.
+
+        Parallel tool_use blocks run on worker threads, so a round costs the
+        slowest search rather than the sum; a lone block runs inline.
+
+        Args:
+            response: API response containing tool_use blocks
+            tool_manager: Manager to execute tools
+            context: Request context that collects tool sources
+
+        Returns:
+            Tuple of (tool_result dictionaries in tool_use order, whether any
+            tool raised)
+        """
+        tool_blocks = [block for block in response.content if block.type == "tool_use"]
+
+        def execute(block: Any) -> "ToolResult | Exception":
+            return self._run_tool(block, tool_manager, context)
+
+        if len(tool_blocks) == 1:
+            outcomes = [execute(tool_blocks[0])]
+        else:
+            # map keeps tool_use order; failures come back as outcomes
+            outcomes = list(self._tool_executor.map(execute, tool_blocks))
+
+        return self._format_tool_results(tool_blocks, outcomes)
 
     def generate_response(
         self,
@@ -96,6 +327,7 @@ Provide only the direct answer to what was asked.
         conversation_history: str | None = None,
         tools: list | None = None,
         tool_manager: "ToolManager | None" = None,
+        context: "SearchContext | None" = None,
     ) -> str:
         """
         Generate AI response with optional tool usage and conversation context.
@@ -106,84 +338,398 @@ Provide only the direct answer to what was asked.
             conversation_history: Previous messages for context
             tools: Available tools the AI can use
             tool_manager: Manager to execute tools
+            context: Request context that collects tool sources
 
         Returns:
             Generated response as string
         """
 
-        # Build system content
-        system_content = (
-            f"{self.SYSTEM_PROMPT}\n\nPrevious conversation:\n{conversation_history}"
-            if conversation_history
-            else self.SYSTEM_PROMPT
-        )
+        # Build cacheable tool definitions
+        cached_tools = self._build_cached_tools(tools) if tools else None
 
-        # Initialize messages and round counter
-        messages = [{"role": "user", "content": query}]
+        # Initialize messages, round counter and final-round flag
+        messages = self._build_initial_messages(query, conversation_history)
         round_count = 0
+        final_round = False
 
-        # Iterative loop for sequential tool calling
-        while round_count < self.MAX_TOOL_ROUNDS:
-            # Prepare API call parameters (use copy to avoid mutation issues)
-            api_params = {
-                **self.base_params,
-                "messages": messages.copy(),
-                "system": system_content,
-            }
+        # Build API parameters once; each round only extends messages
+        api_params = self._build_api_params(messages, cached_tools)
 
-            # Add tools if available
-            if tools:
-                api_params["tools"] = tools
-                api_params["tool_choice"] = {"type": "auto"}
+        # Iterative loop for sequential tool calling; the final round
+        # synthesizes an answer from the gathered tool results
+        while True:
+            if final_round:
+                self._enter_final_round(api_params)
 
             # Make API call
             response = self.client.messages.create(**api_params)
 
-            # Termination condition: No tool use - return text response
-            if response.stop_reason != "tool_use":
+            # Termination condition: No tool use or final round - return text
+            if final_round or response.stop_reason != "tool_use":
                 return response.content[0].text
 
             # Termination condition: Tool use but no tool manager
             if not tool_manager:
-                return "Error: Tool execution requested but no tool manager available"
+                self._mark_failed(context)
+                return self.NO_TOOL_MANAGER_ERROR
 
-            # Execute tools with error handling
-            try:
-                tool_results = self._execute_all_tools(response, tool_manager)
-            except Exception as e:
-                # Tool execution failed - add error result and break
-                messages.append({"role": "assistant", "content": response.content})
-                messages.append(
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": response.content[0].id,
-                                "content": f"Tool execution failed: {e!s}",
-                                "is_error": True,
-                            }
-                        ],
-                    }
-                )
-                break
+            # Execute tools; failed tools are answered with error results
+            tool_results, failed = self._execute_all_tools(
+                response, tool_manager, context
+            )
+            self._append_tool_round(messages, response, tool_results, round_count)
 
-            # Add assistant's tool use to messages
-            messages.append({"role": "assistant", "content": response.content})
+            # Increment round counter; out of rounds or a failed tool means
+            # synthesize next
+            round_count += 1
+            final_round = failed or round_count >= self.MAX_TOOL_ROUNDS
 
-            # Add tool results to messages
-            if tool_results:
-                messages.append({"role": "user", "content": tool_results})
 
-            # Increment round counter
+class AsyncAIGenerator(BaseAIGenerator):
+    """Non-blocking AIGenerator counterpart built on the async Anthropic client"""
+
+    # Seconds between status checks on a submitted message batch
+    BATCH_POLL_INTERVAL = 5.0
+
+    # Seconds a batch may run before it is canceled; batches can otherwise
+    # take up to 24 hours while the caller's HTTP request stays open
+    BATCH_MAX_WAIT = 300.0
+
+    def __init__(
+        self, api_key: str, model: str, http_client: httpx.AsyncClient | None = None
+    ) -> None:
+        # Shared connection pool; None falls back to the SDK's default client
+        self.http_client = http_client
+        super().__init__(api_key, model)
+
+    def _create_client(
+        self, api_key: str, default_headers: dict[str, str]
+    ) -> "anthropic.AsyncAnthropic":
+        """Create an asyncio Anthropic client"""
+        import anthropic  # Deferred like AIGenerator's client
+
+        return anthropic.AsyncAnthropic(
+            api_key=api_key,
+            default_headers=default_headers,
+            http_client=self.http_client,
+        )
+
+    async def warm_up(self) -> None:
+        """Open a pooled connection to the API so the first query skips TLS setup"""
+        if self.http_client is None:
+            return
+
+        try:
+            await self.http_client.head(str(self.client.base_url))
+        except httpx.HTTPError as e:
+            logger.warning("Anthropic connection warm-up failed: %s", e)
+
+    async def _execute_all_tools(
+        self,
+        response: "Message",
+        tool_manager: "ToolManager",
+        context: "SearchContext | None" = None,
+    ) -> tuple[list[dict[str, Any]], bool]:
+        """
+        Execute all tool calls from a response concurrently.
+
+        Tools query ChromaDB synchronously, so each one runs in a worker thread;
+        parallel tool_use blocks then cost the slowest call rather than the sum.
+
+        Args:
+            response: API response containing tool_use blocks
+            tool_manager: Manager to execute tools
+            context: Request context that collects tool sources
+
+        Returns:
+            Tuple of (tool_result dictionaries in tool_use order, whether any
+            tool raised)
+        """
+        tasks = [
+            self._start_tool(block, tool_manager, context)
+            for block in response.content
+            if block.type == "tool_use"
+        ]
+        return await self._gather_tool_results(response, tasks)
+
+    def _start_tool(
+        self,
+        block: Any,
+        tool_manager: "ToolManager",
+        context: "SearchContext | None",
+    ) -> "asyncio.Task[ToolResult | Exception]":
+        """Start running one tool_use block in a worker thread"""
+        return asyncio.create_task(
+            asyncio.to_thread(self._run_tool, block, tool_manager, context)
+        )
+
+    async def _gather_tool_results(
+        self,
+        response: "Message",
+        tasks: "list[asyncio.Task[ToolResult | Exception]]",
+    ) -> tuple[list[dict[str, Any]], bool]:
+        """Await started tool tasks and format their results, in tool_use order"""
+        tool_blocks = [block for block in response.content if block.type == "tool_use"]
+        outcomes = await asyncio.gather(*tasks)
+        return self._format_tool_results(tool_blocks, outcomes)
+
+    async def generate_response(
+        self,
+        query: str,
+        conversation_history: str | None = None,
+        tools: list | None = None,
+        tool_manager: "ToolManager | None" = None,
+        context: "SearchContext | None" = None,
+    ) -> str:
+        """
+        Generate AI response; async equivalent of AIGenerator.generate_response.
+
+        Args:
+            query: The user's question or request
+            conversation_history: Previous messages for context
+            tools: Available tools the AI can use
+            tool_manager: Manager to execute tools
+            context: Request context that collects tool sources
+
+        Returns:
+            Generated response as string
+        """
+        cached_tools = self._build_cached_tools(tools) if tools else None
+
+        messages = self._build_initial_messages(query, conversation_history)
+        round_count = 0
+        final_round = False
+
+        api_params = self._build_api_params(messages, cached_tools)
+
+        while True:
+            if final_round:
+                self._enter_final_round(api_params)
+            response = await self.client.messages.create(**api_params)
+
+            if final_round or response.stop_reason != "tool_use":
+                return response.content[0].text
+
+            if not tool_manager:
+                self._mark_failed(context)
+                return self.NO_TOOL_MANAGER_ERROR
+
+            tool_results, failed = await self._execute_all_tools(
+                response, tool_manager, context
+            )
+            self._append_tool_round(messages, response, tool_results, round_count)
+
             round_count += 1
+            final_round = failed or round_count >= self.MAX_TOOL_ROUNDS
 
-        # Make final API call without tools to get synthesis
-        final_params = {
-            **self.base_params,
-            "messages": messages.copy(),
-            "system": system_content,
-        }
+    async def _run_batch(
+        self, params: dict[int, dict[str, Any]]
+    ) -> dict[int, "Message | Exception"]:
+        """
+        Submit one message batch and wait for every request in it to finish.
+
+        A batch still running after BATCH_MAX_WAIT seconds is canceled, and
+        every request in it fails with TimeoutError.
+
+        Args:
+            params: messages.create parameters keyed by query index
 
-        final_response = self.client.messages.create(**final_params)
-        return final_response.content[0].text
+        Returns:
+            Response messages keyed by query index, with the error in place
+            of each request that did not succeed
+        """
+        batch = await self.client.messages.batches.create(
+            requests=[
+                {"custom_id": f"query-{index}", "params": request}
+                for index, request in params.items()
+            ]
+        )
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.BATCH_MAX_WAIT
+        while batch.processing_status != "ended":
+            if loop.time() >= deadline:
+                await self.client.messages.batches.cancel(batch.id)
+                msg = f"Batch {batch.id} did not end within {self.BATCH_MAX_WAIT:g} s"
+                return dict.fromkeys(params, TimeoutError(msg))
+            await asyncio.sleep(self.BATCH_POLL_INTERVAL)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+
+        outcomes: dict[int, Message | Exception] = {}
+        async for entry in await self.client.messages.batches.results(batch.id):
+            index = int(entry.custom_id.removeprefix("query-"))
+            if entry.result.type == "succeeded":
+                outcomes[index] = entry.result.message
+            else:
+                msg = f"Batch request {entry.custom_id} {entry.result.type}"
+                outcomes[index] = RuntimeError(msg)
+        return outcomes
+
+    async def generate_batch(
+        self,
+        queries: list[tuple[str, str | None]],
+        tools: list | None = None,
+        tool_manager: "ToolManager | None" = None,
+        contexts: "Sequence[SearchContext | None] | None" = None,
+    ) -> list[str | Exception]:
+        """
+        Generate responses to independent queries through the Message Batches API.
+
+        Every tool round is a single batch holding each query still in the
+        tool loop, so N queries cost one submission per round rather than N
+        calls. Batches are billed at half price but can take minutes to end.
+
+        Args:
+            queries: (query, conversation_history) pairs
+            tools: Available tools the AI can use
+            tool_manager: Manager to execute tools
+            contexts: Request contexts that collect each query's tool sources
+
+        Returns:
+            Generated responses in query order, with the error in place of
+            each query whose batch request failed
+        """
+        cached_tools = self._build_cached_tools(tools) if tools else None
+        contexts = contexts or [None] * len(queries)
+
+        conversations = [
+            self._build_initial_messages(query, history) for query, history in queries
+        ]
+        params = [self._build_api_params(m, cached_tools) for m in conversations]
+        answers: list[str | Exception] = [""] * len(queries)
+
+        # Queries still in the tool loop, mapped to whether their next round
+        # is the final synthesis round
+        pending = dict.fromkeys(range(len(queries)), False)
+        round_count = 0
+
+        while pending:
+            for index, final_round in pending.items():
+                if final_round:
+                    self._enter_final_round(params[index])
+            responses = await self._run_batch(
+                {index: params[index] for index in pending}
+            )
+
+            tool_rounds: dict[int, Message] = {}
+            for index, final_round in pending.items():
+                response = responses[index]
+                if isinstance(response, Exception):
+                    # Only this query fails; the others carry on
+                    answers[index] = response
+                elif final_round or response.stop_reason != "tool_use":
+                    answers[index] = cast("TextBlock", response.content[0]).text
+                elif not tool_manager:
+                    self._mark_failed(contexts[index])
+                    answers[index] = self.NO_TOOL_MANAGER_ERROR
+                else:
+                    tool_rounds[index] = response
+
+            # Every query's tools run at once before the next batch is sent;
+            # without a tool manager no query reaches a tool round
+            outcomes = (
+                await asyncio.gather(
+                    *(
+                        self._execute_all_tools(response, tool_manager, contexts[index])
+                        for index, response in tool_rounds.items()
+                    )
+                )
+                if tool_manager
+                else []
+            )
+
+            pending = {}
+            for (index, response), (tool_results, failed) in zip(
+                tool_rounds.items(), outcomes, strict=True
+            ):
+                self._append_tool_round(
+                    conversations[index], response, tool_results, round_count
+                )
+                # A failed tool means synthesizing an explanation next
+                pending[index] = failed or round_count + 1 >= self.MAX_TOOL_ROUNDS
+            round_count += 1
+
+        return answers
+
+    async def astream_response(
+        self,
+        query: str,
+        conversation_history: str | None = None,
+        tools: list | None = None,
+        tool_manager: "ToolManager | None" = None,
+        context: "SearchContext | None" = None,
+    ) -> AsyncIterator[dict[str, Any]]:
+        """
+        Generate AI response, yielding text as Claude writes it.
+
+        Each round's stream is drained to its stop_reason. Text written in a
+        tool-use round (a preamble to the tool calls) streams like the answer,
+        followed by a tool_round event so callers can tell it apart from the
+        final round's text. A tool starts as soon as its tool_use block is
+        complete, overlapping with Claude writing the rest of the message.
+
+        Args:
+            query: The user's question or request
+            conversation_history: Previous messages for context
+            tools: Available tools the AI can use
+            tool_manager: Manager to execute tools
+            context: Request context that collects tool sources
+
+        Yields:
+            {"type": "text", "text": ...} events for each chunk of the response,
+            and a {"type": "tool_round"} event after each tool-use round's text
+        """
+        cached_tools = self._build_cached_tools(tools) if tools else None
+
+        messages = self._build_initial_messages(query, conversation_history)
+        round_count = 0
+        final_round = False
+
+        api_params = self._build_api_params(messages, cached_tools)
+
+        while True:
+            if final_round:
+                self._enter_final_round(api_params)
+
+            tasks: list[asyncio.Task[ToolResult | Exception]] = []
+            try:
+                async with self.client.messages.stream(**api_params) as stream:
+                    async for event in stream:
+                        if event.type == "text":
+                            yield {"type": "text", "text": event.text}
+                        elif (
+                            event.type == "content_block_stop"
+                            and event.content_block.type == "tool_use"
+                            and tool_manager
+                            and not final_round
+                        ):
+                            tasks.append(
+                                self._start_tool(
+                                    event.content_block, tool_manager, context
+                                )
+                            )
+                    response = await stream.get_final_message()
+
+                if final_round or response.stop_reason != "tool_use":
+                    return
+
+                yield {"type": "tool_round"}
+
+                if not tool_manager:
+                    self._mark_failed(context)
+                    yield {"type": "text", "text": self.NO_TOOL_MANAGER_ERROR}
+                    return
+
+                tool_results, failed = await self._gather_tool_results(response, tasks)
+            finally:
+                # A failed stream or a caller that stopped reading can leave
+                # tools running in worker threads, which task.cancel() cannot
+                # stop. Keep queued ones from starting and wait out the rest,
+                # so none writes to the context once the stream has ended
+                if not all(task.done() for task in tasks):
+                    self._cancel_tools(context)
+                    await asyncio.gather(*tasks, return_exceptions=True)
+
+            self._append_tool_round(messages, response, tool_results, round_count)
+
+            round_count += 1
+            final_round = failed or round_count >= self.MAX_TOOL_ROUNDS
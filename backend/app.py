@@ -2,19 +2,32 @@ import warnings
 
 warnings.filterwarnings("ignore", message="resource_tracker: There appear to be.*")
 
+import asyncio
+import hashlib
+import logging
 import os
-from typing import Any
-
+import ssl
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from functools import cache
+from typing import Annotated, Any
+
+import httpx
+import orjson
+from cachetools import TTLCache
 from config import config
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from rag_system import RAGSystem
 
-# Global RAG system instance
-rag_system = None
+logging.basicConfig(
+    level=config.LOG_LEVEL, format="%(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
 
 
 # Pydantic models for request/response
@@ -33,6 +46,24 @@ class QueryResponse(BaseModel):
     session_id: str
 
 
+class BatchQueryRequest(BaseModel):
+    """Request model for answering several independent queries together"""
+
+    queries: list[QueryRequest] = Field(min_length=1)
+
+
+class BatchQueryResult(QueryResponse):
+    """One batched query's answer, or why it could not be answered"""
+
+    error: str | None = None
+
+
+class BatchQueryResponse(BaseModel):
+    """Response model for batched queries, in request order"""
+
+    results: list[BatchQueryResult]
+
+
 class CourseInfo(BaseModel):
     """Information about a single course"""
 
@@ -47,19 +78,138 @@ class CourseStats(BaseModel):
     courses: list[CourseInfo]
 
 
-def create_app(mount_static: bool = True, skip_startup: bool = False) -> FastAPI:
+class IngestionStatus(BaseModel):
+    """Progress of background document ingestion"""
+
+    state: str  # idle, running, complete or failed
+    courses: int
+    chunks: int
+    error: str | None = None
+
+
+class HealthResponse(BaseModel):
+    """Response model for service health checks"""
+
+    status: str
+    ingestion: IngestionStatus
+
+
+def _sse(event: dict[str, Any]) -> bytes:
+    """Encode one server-sent event carrying a JSON payload"""
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+
+def _stream_answer(
+    rag_system: RAGSystem, query: str, session_id: str
+) -> StreamingResponse:
+    """Stream a query's answer as server-sent events, ending with a done event"""
+
+    async def events() -> AsyncIterator[bytes]:
+        try:
+            async for event in rag_system.astream(query, session_id):
+                yield _sse(event)
+        except Exception as e:
+            # Headers are already sent, so report failures in-stream
+            yield _sse({"type": "error", "detail": str(e)})
+        yield _sse({"type": "done", "session_id": session_id})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@cache
+def _ssl_context() -> ssl.SSLContext:
+    """TLS context shared by every app instance's HTTP pool"""
+    # Loading the CA bundle is most of the cost of building a client
+    return httpx.create_ssl_context()
+
+
+async def _start_up(app: FastAPI) -> None:
+    """Warm up the Anthropic connection and load initial documents"""
+    rag_system = app.state.rag_system
+    await rag_system.async_ai_generator.warm_up()
+
+    docs_path = "../docs"
+    if os.path.exists(docs_path):
+        logger.info("Loading initial documents in the background...")
+        # Ingest off the event loop so the server answers health checks
+        # meanwhile; keep a reference so the task is not collected
+        app.state.ingestion_task = asyncio.create_task(
+            asyncio.to_thread(rag_system.ingest_folder, docs_path)
+        )
+
+
+async def _shut_down(app: FastAPI) -> None:
+    """Wait for background ingestion before the shared clients are closed"""
+    task = getattr(app.state, "ingestion_task", None)
+    if task is None:
+        return
+    try:
+        # On timeout the task is cancelled; its thread cannot be stopped
+        await asyncio.wait_for(task, config.INGESTION_SHUTDOWN_TIMEOUT)
+    except TimeoutError:
+        logger.warning("Shutting down while document ingestion is still running")
+    except Exception:
+        logger.exception("Background document ingestion failed")
+
+
+def get_rag_system(request: Request) -> RAGSystem:
+    """Dependency returning the RAG system created by the app's lifespan"""
+    return request.app.state.rag_system
+
+
+RAGSystemDep = Annotated[RAGSystem, Depends(get_rag_system)]
+
+
+def create_app(
+    mount_static: bool = True,
+    skip_startup: bool = False,
+    rag_system: RAGSystem | None = None,
+) -> FastAPI:
     """
     Factory function to create FastAPI app with configurable options.
 
     Args:
         mount_static: If True, mount static files from ../frontend directory
-        skip_startup: If True, skip startup event (useful for testing)
+        skip_startup: If True, skip warm-up and document loading (useful for testing)
+        rag_system: Prebuilt RAG system to serve instead of creating one on startup
 
     Returns:
         Configured FastAPI application instance
     """
-    # Initialize FastAPI app
-    app = FastAPI(title="Course Materials RAG System", root_path="")
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+        """Create shared clients and the RAG system, closing them on shutdown"""
+        # Shared connection pool for Anthropic API calls
+        async with httpx.AsyncClient(
+            http2=True,
+            verify=_ssl_context(),
+            limits=httpx.Limits(
+                max_connections=config.ANTHROPIC_MAX_CONNECTIONS,
+                max_keepalive_connections=config.ANTHROPIC_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(config.ANTHROPIC_TIMEOUT),
+        ) as http_client:
+            app.state.http_client = http_client
+            app.state.rag_system = rag_system or RAGSystem(
+                config, http_client=http_client
+            )
+
+            if not skip_startup:
+                await _start_up(app)
+
+            try:
+                yield
+            finally:
+                await _shut_down(app)
+
+    # Initialize FastAPI app, serializing responses with orjson
+    app = FastAPI(
+        title="Course Materials RAG System",
+        root_path="",
+        default_response_class=ORJSONResponse,
+        lifespan=lifespan,
+    )
 
     # Add trusted host middleware for proxy
     app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
@@ -74,42 +224,124 @@ def create_app(mount_static: bool = True, skip_startup: bool = False) -> FastAPI
         expose_headers=["*"],
     )
 
-    # Initialize RAG system
-    global rag_system  # noqa: PLW0603
-    rag_system = RAGSystem(config)
-
     # API Endpoints
 
     @app.post("/api/query", response_model=QueryResponse)
-    async def query_documents(request: QueryRequest) -> QueryResponse:
-        """Process a query and return response with sources"""
+    async def query_documents(
+        request: QueryRequest, http_request: Request, rag_system: RAGSystemDep
+    ) -> QueryResponse | StreamingResponse:
+        """
+        Process a query and return response with sources.
+
+        Clients sending Accept: text/event-stream get the answer streamed as
+        server-sent events, the same as /api/query/stream.
+        """
         try:
             # Create session if not provided
             session_id = request.session_id
             if not session_id:
                 session_id = rag_system.session_manager.create_session()
 
-            # Process query using RAG system
-            answer, sources = rag_system.query(request.query, session_id)
+            if "text/event-stream" in http_request.headers.get("accept", ""):
+                return _stream_answer(rag_system, request.query, session_id)
+
+            # Process query using RAG system without blocking the event loop
+            answer, sources = await rag_system.aquery(request.query, session_id)
 
             return QueryResponse(answer=answer, sources=sources, session_id=session_id)
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e)) from e
 
-    @app.get("/api/courses", response_model=CourseStats)
-    async def get_course_stats() -> CourseStats:
-        """Get course analytics and statistics"""
+    @app.post("/api/query/batch", response_model=BatchQueryResponse)
+    async def query_documents_batch(
+        request: BatchQueryRequest, rag_system: RAGSystemDep
+    ) -> BatchQueryResponse:
+        """
+        Answer several queries with one Message Batches submission per tool round.
+
+        A query whose batch request failed or timed out gets an empty answer
+        and its error, without failing the rest of the batch.
+        """
         try:
-            analytics = rag_system.get_course_analytics()
-            return CourseStats(
-                total_courses=analytics["total_courses"],
-                courses=analytics["courses"],
+            session_ids = [
+                query.session_id or rag_system.session_manager.create_session()
+                for query in request.queries
+            ]
+            results = await rag_system.abatch_query(
+                [
+                    (query.query, session_id)
+                    for query, session_id in zip(
+                        request.queries, session_ids, strict=True
+                    )
+                ]
+            )
+
+            return BatchQueryResponse(
+                results=[
+                    BatchQueryResult(
+                        answer="", sources=[], session_id=session_id, error=str(result)
+                    )
+                    if isinstance(result, Exception)
+                    else BatchQueryResult(
+                        answer=result[0], sources=result[1], session_id=session_id
+                    )
+                    for result, session_id in zip(results, session_ids, strict=True)
+                ]
             )
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e)) from e
 
+    @app.post("/api/query/stream")
+    async def query_documents_stream(
+        request: QueryRequest, rag_system: RAGSystemDep
+    ) -> StreamingResponse:
+        """Process a query, streaming the response as server-sent events"""
+        session_id = request.session_id
+        if not session_id:
+            session_id = rag_system.session_manager.create_session()
+
+        return _stream_answer(rag_system, request.query, session_id)
+
+    # Encoded catalog and its ETag, keyed by the vector store's catalog version
+    courses_cache: TTLCache[int, tuple[bytes, str]] = TTLCache(
+        maxsize=1, ttl=config.COURSES_CACHE_TTL
+    )
+
+    @app.get("/api/courses", response_model=CourseStats)
+    async def get_course_stats(request: Request, rag_system: RAGSystemDep) -> Response:
+        """Get course analytics and statistics, answering 304 for a matching ETag"""
+        version = rag_system.vector_store.catalog_version
+        cached = courses_cache.get(version)
+        if cached is None:
+            try:
+                analytics = rag_system.get_course_analytics()
+                stats = CourseStats(
+                    total_courses=analytics["total_courses"],
+                    courses=analytics["courses"],
+                )
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=str(e)) from e
+            body = orjson.dumps(stats.model_dump())
+            etag = f'"{hashlib.md5(body, usedforsecurity=False).hexdigest()}"'
+            cached = courses_cache[version] = (body, etag)
+
+        body, etag = cached
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+
+    @app.get("/api/health", response_model=HealthResponse)
+    async def health(rag_system: RAGSystemDep) -> HealthResponse:
+        """Report liveness and document ingestion progress"""
+        return HealthResponse(
+            status="ok",
+            ingestion=IngestionStatus.model_validate(rag_system.ingestion_status),
+        )
+
     @app.delete("/api/session/{session_id}")
-    async def clear_session(session_id: str) -> dict[str, str]:
+    async def clear_session(
+        session_id: str, rag_system: RAGSystemDep
+    ) -> dict[str, str]:
         """Clear a session's conversation history"""
         try:
             rag_system.session_manager.clear_session(session_id)
@@ -117,22 +349,14 @@ def create_app(mount_static: bool = True, skip_startup: bool = False) -> FastAPI
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e)) from e
 
-    # Conditional startup event
-    if not skip_startup:
-
-        @app.on_event("startup")
-        async def startup_event() -> None:
-            """Load initial documents on startup"""
-            docs_path = "../docs"
-            if os.path.exists(docs_path):
-                print("Loading initial documents...")
-                try:
-                    courses, chunks = rag_system.add_course_folder(
-                        docs_path, clear_existing=False
-                    )
-                    print(f"Loaded {courses} courses with {chunks} chunks")
-                except Exception as e:
-                    print(f"Error loading documents: {e}")
+    @app.post("/api/cache/clear")
+    async def clear_cache(rag_system: RAGSystemDep) -> dict[str, str]:
+        """Clear cached answers to repeated questions"""
+        try:
+            rag_system.clear_cache()
+            return {"status": "ok", "message": "Cache cleared"}
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e)) from e
 
     # Conditional static file mounting
     if mount_static:
@@ -144,8 +368,9 @@ def create_app(mount_static: bool = True, skip_startup: bool = False) -> FastAPI
             )
         else:
             # In development/testing without frontend
-            print(
-                f"Warning: Frontend directory '{frontend_dir}' not found. Skipping static file mounting."
+            logger.warning(
+                "Frontend directory '%s' not found. Skipping static file mounting.",
+                frontend_dir,
             )
 
     return app
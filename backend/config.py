@@ -15,6 +15,11 @@ class Config:
     ANTHROPIC_API_KEY: str = os.getenv("ANTHROPIC_API_KEY", "")
     ANTHROPIC_MODEL: str = "claude-sonnet-4-20250514"
 
+    # Anthropic HTTP connection pool settings
+    ANTHROPIC_MAX_CONNECTIONS: int = 512  # Concurrent in-flight API requests
+    ANTHROPIC_MAX_KEEPALIVE: int = 256  # Idle connections kept open for reuse
+    ANTHROPIC_TIMEOUT: float = 60.0  # Seconds before an API request times out
+
     # Embedding model settings
     EMBEDDING_MODEL: str = "all-MiniLM-L6-v2"
 
@@ -23,9 +28,27 @@ class Config:
     CHUNK_OVERLAP: int = 100  # Characters to overlap between chunks
     MAX_RESULTS: int = 5  # Maximum search results to return
     MAX_HISTORY: int = 2  # Number of conversation messages to remember
+    HISTORY_BUFFER: int = 2  # Extra exchanges kept before trimming in one batch
+
+    # Semantic cache for repeated questions (0 disables it)
+    SEMANTIC_CACHE_SIZE: int = 1024  # Maximum cached answers
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95  # Cosine similarity needed for a hit
+
+    # Exact-repeat cache checked before embedding the query (0 disables it)
+    RESPONSE_CACHE_SIZE: int = 1024  # Maximum cached answers
+    RESPONSE_CACHE_TTL: int = 600  # Seconds a cached answer stays valid
+
+    # Seconds /api/courses reuses its response until the catalog changes
+    COURSES_CACHE_TTL: int = 60
+
+    # Seconds shutdown waits for background document ingestion to finish
+    INGESTION_SHUTDOWN_TIMEOUT: float = 10.0
 
     # Database paths
     CHROMA_PATH: str = "./chroma_db"  # ChromaDB storage location
 
+    # Logging settings
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+
 
 config = Config()
@@ -1,18 +1,38 @@
+import asyncio
+import hashlib
+import logging
 import os
-
-from ai_generator import AIGenerator
+from collections.abc import AsyncIterator
+from functools import cached_property
+from typing import Any
+
+import httpx
+import numpy as np
+from ai_generator import AIGenerator, AsyncAIGenerator
+from cachetools import TTLCache
 from config import Config
 from document_processor import DocumentProcessor
 from models import Course
-from search_tools import CourseOutlineTool, CourseSearchTool, ToolManager
+from search_tools import (
+    BatchTool,
+    CourseOutlineTool,
+    CourseSearchTool,
+    SearchContext,
+    ToolManager,
+)
+from semantic_cache import SemanticCache
 from session_manager import SessionManager
 from vector_store import VectorStore
 
+logger = logging.getLogger(__name__)
+
 
 class RAGSystem:
     """Main orchestrator for the Retrieval-Augmented Generation system"""
 
-    def __init__(self, config: Config) -> None:
+    def __init__(
+        self, config: Config, http_client: httpx.AsyncClient | None = None
+    ) -> None:
         self.config = config
 
         # Initialize core components
@@ -22,10 +42,10 @@ class RAGSystem:
         self.vector_store = VectorStore(
             config.CHROMA_PATH, config.EMBEDDING_MODEL, config.MAX_RESULTS
         )
-        self.ai_generator = AIGenerator(
-            config.ANTHROPIC_API_KEY, config.ANTHROPIC_MODEL
+        self.async_ai_generator = AsyncAIGenerator(
+            config.ANTHROPIC_API_KEY, config.ANTHROPIC_MODEL, http_client
         )
-        self.session_manager = SessionManager(config.MAX_HISTORY)
+        self.session_manager = SessionManager(config.MAX_HISTORY, config.HISTORY_BUFFER)
 
         # Initialize search tools
         self.tool_manager = ToolManager()
@@ -33,6 +53,41 @@ class RAGSystem:
         self.outline_tool = CourseOutlineTool(self.vector_store)
         self.tool_manager.register_tool(self.search_tool)
         self.tool_manager.register_tool(self.outline_tool)
+        self.batch_tool = BatchTool(self.tool_manager)
+        self.tool_manager.register_tool(self.batch_tool)
+
+        # Answers for exact repeats, looked up before any embedding work
+        self.response_cache: TTLCache[str, tuple[str, list[dict[str, Any]]]] | None = (
+            None
+        )
+        if config.RESPONSE_CACHE_SIZE:
+            self.response_cache = TTLCache(
+                config.RESPONSE_CACHE_SIZE, config.RESPONSE_CACHE_TTL
+            )
+
+        # Answers for near-duplicate questions, reusing the store's embeddings
+        self.semantic_cache: SemanticCache | None = None
+        if config.SEMANTIC_CACHE_SIZE:
+            self.semantic_cache = SemanticCache(
+                self.vector_store.embedding_function,
+                config.SEMANTIC_CACHE_SIZE,
+                config.SEMANTIC_CACHE_THRESHOLD,
+            )
+
+        # Progress of background document ingestion, reported by /api/health
+        self.ingestion_status: dict[str, Any] = {
+            "state": "idle",
+            "courses": 0,
+            "chunks": 0,
+            "error": None,
+        }
+
+    @cached_property
+    def ai_generator(self) -> AIGenerator:
+        """Blocking generator for query(), built on first use"""
+        # The app only serves the async paths, so skip the extra client and
+        # tool thread pool unless something calls query()
+        return AIGenerator(self.config.ANTHROPIC_API_KEY, self.config.ANTHROPIC_MODEL)
 
     def add_course_document(self, file_path: str) -> tuple[Course, int]:
         """
@@ -58,7 +113,7 @@ class RAGSystem:
 
             return course, len(course_chunks)
         except Exception as e:
-            print(f"Error processing course document {file_path}: {e}")
+            logger.error("Error processing course document %s: %s", file_path, e)
             return None, 0
 
     def add_course_folder(
@@ -79,11 +134,11 @@ class RAGSystem:
 
         # Clear existing data if requested
         if clear_existing:
-            print("Clearing existing data for fresh rebuild...")
+            logger.info("Clearing existing data for fresh rebuild...")
             self.vector_store.clear_all_data()
 
         if not os.path.exists(folder_path):
-            print(f"Folder {folder_path} does not exist")
+            logger.warning("Folder %s does not exist", folder_path)
             return 0, 0
 
         # Get existing course titles to avoid re-processing
@@ -108,18 +163,54 @@ class RAGSystem:
                         self.vector_store.add_course_content(course_chunks)
                         total_courses += 1
                         total_chunks += len(course_chunks)
-                        print(
-                            f"Added new course: {course.title} ({len(course_chunks)} chunks)"
+                        logger.info(
+                            "Added new course: %s (%d chunks)",
+                            course.title,
+                            len(course_chunks),
                         )
                         existing_course_titles.add(course.title)
                     elif course:
-                        print(f"Course already exists: {course.title} - skipping")
+                        logger.info(
+                            "Course already exists: %s - skipping", course.title
+                        )
                 except Exception as e:
-                    print(f"Error processing {file_name}: {e}")
+                    logger.error("Error processing %s: %s", file_name, e)
 
         return total_courses, total_chunks
 
-    def query(self, query: str, session_id: str | None = None) -> tuple[str, list[str]]:
+    def ingest_folder(self, folder_path: str) -> None:
+        """
+        Add new course documents from a folder, tracking ingestion_status.
+
+        Args:
+            folder_path: Path to folder containing course documents
+        """
+        self.ingestion_status = {**self.ingestion_status, "state": "running"}
+        try:
+            courses, chunks = self.add_course_folder(folder_path, clear_existing=False)
+        except Exception as e:
+            logger.error("Error loading documents: %s", e)
+            self.ingestion_status = {
+                **self.ingestion_status,
+                "state": "failed",
+                "error": str(e),
+            }
+            return
+
+        logger.info("Loaded %d courses with %d chunks", courses, chunks)
+        if courses:
+            # Answers given while the catalog was smaller may now be incomplete
+            self.clear_cache()
+        self.ingestion_status = {
+            "state": "complete",
+            "courses": courses,
+            "chunks": chunks,
+            "error": None,
+        }
+
+    def query(
+        self, query: str, session_id: str | None = None
+    ) -> tuple[str, list[dict[str, Any]]]:
         """
         Process a user query using the RAG system with tool-based search.
 
@@ -130,34 +221,267 @@ class RAGSystem:
         Returns:
             Tuple of (response, sources list - empty for tool-based approach)
         """
-        # Create prompt for the AI with clear instructions
-        prompt = f"""Answer this question about course materials: {query}"""
+        prompt, history = self._prepare_query(query, session_id)
+
+        # Serve exact repeats, then near-duplicates, from the caches
+        key, cached = self._lookup_response(query, session_id, history)
+        if cached is not None:
+            return cached
+        embedding = self._embed_for_cache(query)
+        cached = self._lookup_cache(query, session_id, history, embedding)
+        if cached is not None:
+            return cached
+
+        # Generate response using AI with tools, collecting this query's sources
+        context = SearchContext()
+        response = self.ai_generator.generate_response(
+            query=prompt,
+            conversation_history=history,
+            tools=self.tool_manager.get_tool_definitions(),
+            tool_manager=self.tool_manager,
+            context=context,
+        )
 
-        # Get conversation history if session exists
-        history = None
-        if session_id:
-            history = self.session_manager.get_conversation_history(session_id)
+        # Return response with sources from tool searches
+        sources = self._finish_query(query, session_id, response, context)
+        self._store_cache(key, embedding, history, response, context)
+        return response, sources
 
-        # Generate response using AI with tools
-        response = self.ai_generator.generate_response(
+    async def aquery(
+        self, query: str, session_id: str | None = None
+    ) -> tuple[str, list[dict[str, Any]]]:
+        """
+        Process a user query without blocking the event loop.
+
+        Args:
+            query: User's question
+            session_id: Optional session ID for conversation context
+
+        Returns:
+            Tuple of (response, sources list)
+        """
+        prompt, history = self._prepare_query(query, session_id)
+
+        key, cached = self._lookup_response(query, session_id, history)
+        if cached is not None:
+            return cached
+        embedding = await self._aembed_for_cache(query)
+        cached = self._lookup_cache(query, session_id, history, embedding)
+        if cached is not None:
+            return cached
+
+        context = SearchContext()
+        response = await self.async_ai_generator.generate_response(
             query=prompt,
             conversation_history=history,
             tools=self.tool_manager.get_tool_definitions(),
             tool_manager=self.tool_manager,
+            context=context,
+        )
+
+        sources = self._finish_query(query, session_id, response, context)
+        self._store_cache(key, embedding, history, response, context)
+        return response, sources
+
+    async def astream(
+        self, query: str, session_id: str | None = None
+    ) -> AsyncIterator[dict[str, Any]]:
+        """
+        Process a user query, yielding the response as it is generated.
+
+        Args:
+            query: User's question
+            session_id: Optional session ID for conversation context
+
+        Yields:
+            {"type": "text", "text": ...} events for each chunk of the response,
+            a {"type": "tool_round"} event discarding the text streamed so far
+            whenever Claude used tools after it, then one
+            {"type": "sources", "sources": [...]} event
+        """
+        prompt, history = self._prepare_query(query, session_id)
+
+        key, cached = self._lookup_response(query, session_id, history)
+        if cached is None:
+            embedding = await self._aembed_for_cache(query)
+            cached = self._lookup_cache(query, session_id, history, embedding)
+        if cached is not None:
+            answer, sources = cached
+            yield {"type": "text", "text": answer}
+            yield {"type": "sources", "sources": sources}
+            return
+
+        context = SearchContext()
+        chunks: list[str] = []
+        async for event in self.async_ai_generator.astream_response(
+            query=prompt,
+            conversation_history=history,
+            tools=self.tool_manager.get_tool_definitions(),
+            tool_manager=self.tool_manager,
+            context=context,
+        ):
+            if event["type"] == "tool_round":
+                # Only the final round's text is the answer, as in aquery;
+                # the client drops the preamble it has shown as well
+                chunks.clear()
+            else:
+                chunks.append(event["text"])
+            yield event
+
+        response = "".join(chunks)
+        sources = self._finish_query(query, session_id, response, context)
+        self._store_cache(key, embedding, history, response, context)
+        yield {"type": "sources", "sources": sources}
+
+    async def abatch_query(
+        self, queries: list[tuple[str, str | None]]
+    ) -> list[tuple[str, list[dict[str, Any]]] | Exception]:
+        """
+        Process independent queries together through the Message Batches API.
+
+        Args:
+            queries: (query, session ID) pairs
+
+        Returns:
+            (response, sources list) tuples in query order, with the error in
+            place of each query that could not be answered
+        """
+        prepared = [
+            self._prepare_query(query, session_id) for query, session_id in queries
+        ]
+        contexts = [SearchContext() for _ in queries]
+        responses = await self.async_ai_generator.generate_batch(
+            prepared,
+            tools=self.tool_manager.get_tool_definitions(),
+            tool_manager=self.tool_manager,
+            contexts=contexts,
         )
 
-        # Get sources from the search tool
-        sources = self.tool_manager.get_last_sources()
+        return [
+            response
+            if isinstance(response, Exception)
+            else (response, self._finish_query(query, session_id, response, context))
+            for (query, session_id), response, context in zip(
+                queries, responses, contexts, strict=True
+            )
+        ]
 
-        # Reset sources after retrieving them
-        self.tool_manager.reset_sources()
+    def _prepare_query(
+        self, query: str, session_id: str | None
+    ) -> tuple[str, str | None]:
+        """Build the AI prompt and look up conversation history for a query"""
+        # Create prompt for the AI with clear instructions
+        prompt = f"""Answer this question about course materials: {query}"""
 
+        # Get conversation history if session exists
+        history = None
+        if session_id:
+            history = self.session_manager.get_conversation_history(session_id)
+
+        return prompt, history
+
+    def _finish_query(
+        self,
+        query: str,
+        session_id: str | None,
+        response: str,
+        context: SearchContext,
+    ) -> list[dict[str, Any]]:
+        """Record the exchange and return the sources the tools collected"""
         # Update conversation history
         if session_id:
             self.session_manager.add_exchange(session_id, query, response)
 
-        # Return response with sources from tool searches
-        return response, sources
+        return context.sources
+
+    def _embed_for_cache(self, query: str) -> np.ndarray | None:
+        """Embed a query for the semantic cache, or None when it is disabled"""
+        if self.semantic_cache is None:
+            return None
+        return self.semantic_cache.embed(query)
+
+    async def _aembed_for_cache(self, query: str) -> np.ndarray | None:
+        """Embed a query for the semantic cache without blocking the event loop"""
+        if self.semantic_cache is None:
+            return None
+        # Embedding runs the sentence transformer, so keep it off the loop
+        return await asyncio.to_thread(self.semantic_cache.embed, query)
+
+    def _response_key(self, query: str, history: str | None) -> str:
+        """Digest a query with its history and the tools that could answer it"""
+        parts = [query, history or "", *sorted(self.tool_manager.tools)]
+        return hashlib.sha1(
+            "\0".join(parts).encode(), usedforsecurity=False
+        ).hexdigest()
+
+    def _lookup_response(
+        self, query: str, session_id: str | None, history: str | None
+    ) -> tuple[str | None, tuple[str, list[dict[str, Any]]] | None]:
+        """
+        Look a query up in the exact-repeat cache.
+
+        Returns:
+            Tuple of (cache key, cached answer or None); the key is None when
+            the cache is disabled
+        """
+        if self.response_cache is None:
+            return None, None
+
+        key = self._response_key(query, history)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            self._record_cache_hit(query, session_id, cached)
+        return key, cached
+
+    def _lookup_cache(
+        self,
+        query: str,
+        session_id: str | None,
+        history: str | None,
+        embedding: np.ndarray | None,
+    ) -> tuple[str, list[dict[str, Any]]] | None:
+        """Return a cached answer, recording it in the session like a fresh one"""
+        if embedding is None or self.semantic_cache is None:
+            return None
+
+        cached = self.semantic_cache.lookup(embedding, history)
+        if cached is not None:
+            self._record_cache_hit(query, session_id, cached)
+        return cached
+
+    def _record_cache_hit(
+        self,
+        query: str,
+        session_id: str | None,
+        cached: tuple[str, list[dict[str, Any]]],
+    ) -> None:
+        """Add a cached answer to the session as if it were freshly generated"""
+        if session_id:
+            self.session_manager.add_exchange(session_id, query, cached[0])
+
+    def _store_cache(
+        self,
+        key: str | None,
+        embedding: np.ndarray | None,
+        history: str | None,
+        response: str,
+        context: SearchContext,
+    ) -> None:
+        """Remember a generated answer for repeated and similar future questions"""
+        # An answer explaining a tool failure would outlive the outage
+        if context.failed:
+            return
+        if key is not None and self.response_cache is not None:
+            self.response_cache[key] = (response, context.sources)
+        if embedding is not None and self.semantic_cache is not None:
+            self.semantic_cache.store(embedding, history, response, context.sources)
+
+    def clear_cache(self) -> None:
+        """Drop every cached answer"""
+        if self.response_cache is not None:
+            self.response_cache.clear()
+        if self.semantic_cache is not None:
+            self.semantic_cache.clear()
 
     def get_course_analytics(self) -> dict:
         """Get analytics about the course catalog"""
@@ -1,9 +1,31 @@
-import json
+import logging
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from typing import Any
 
+import orjson
 from vector_store import SearchResults, VectorStore
 
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ToolResult:
+    """Output of a tool call, flagged when it reports a failure"""
+
+    content: str
+    is_error: bool = False
+
+
+@dataclass
+class SearchContext:
+    """Per-request state collected by the tools answering one query"""
+
+    sources: list[dict[str, Any]] = field(default_factory=list)  # Shown in the UI
+    failed: bool = False  # A tool errored, so the answer may be transient
+    cancelled: bool = False  # The request was abandoned, so start no more tools
+
 
 class Tool(ABC):
     """Abstract base class for all tools"""
@@ -13,8 +35,8 @@ class Tool(ABC):
         """Return Anthropic tool definition for this tool"""
 
     @abstractmethod
-    def execute(self, **kwargs: Any) -> str:
-        """Execute the tool with given parameters"""
+    def execute(self, *args: Any, **kwargs: Any) -> ToolResult:
+        """Execute the tool with given parameters, recording sources in context"""
 
 
 class CourseSearchTool(Tool):
@@ -22,11 +44,9 @@ class CourseSearchTool(Tool):
 
     def __init__(self, vector_store: VectorStore) -> None:
         self.store = vector_store
-        self.last_sources = []  # Track sources from last search
 
-    def get_tool_definition(self) -> dict[str, Any]:
-        """Return Anthropic tool definition for this tool"""
-        return {
+        # Definition never changes, so build it once per tool
+        self._definition = {
             "name": "search_course_content",
             "description": "Search course materials with smart course name matching and lesson filtering",
             "input_schema": {
@@ -49,12 +69,17 @@ class CourseSearchTool(Tool):
             },
         }
 
+    def get_tool_definition(self) -> dict[str, Any]:
+        """Return Anthropic tool definition for this tool"""
+        return self._definition
+
     def execute(
         self,
         query: str,
         course_name: str | None = None,
         lesson_number: int | None = None,
-    ) -> str:
+        context: SearchContext | None = None,
+    ) -> ToolResult:
         """
         Execute the search tool with given parameters.
 
@@ -62,6 +87,7 @@ class CourseSearchTool(Tool):
             query: What to search for
             course_name: Optional course filter
             lesson_number: Optional lesson filter
+            context: Request context that receives the result sources
 
         Returns:
             Formatted search results or error message
@@ -74,7 +100,7 @@ class CourseSearchTool(Tool):
 
         # Handle errors
         if results.error:
-            return results.error
+            return ToolResult(results.error, is_error=True)
 
         # Handle empty results
         if results.is_empty():
@@ -83,55 +109,62 @@ class CourseSearchTool(Tool):
                 filter_info += f" in course '{course_name}'"
             if lesson_number:
                 filter_info += f" in lesson {lesson_number}"
-            return f"No relevant content found{filter_info}."
+            return ToolResult(f"No relevant content found{filter_info}.")
 
         # Format and return results
-        return self._format_results(results)
+        return ToolResult(self._format_results(results, context))
 
-    def _format_results(self, results: SearchResults) -> str:
+    def _format_results(
+        self, results: SearchResults, context: SearchContext | None
+    ) -> str:
         """Format search results with course and lesson context"""
-        formatted = []
-        sources = []  # Track sources for the UI
-
-        for doc, meta in zip(results.documents, results.metadata, strict=False):
-            course_title = meta.get("course_title", "unknown")
-            lesson_num = meta.get("lesson_number")
-
-            # Build context header
-            header = f"[{course_title}"
-            if lesson_num is not None:
-                header += f" - Lesson {lesson_num}"
-            header += "]"
-
-            # Build source text
-            source_text = course_title
-            if lesson_num is not None:
-                source_text += f" - Lesson {lesson_num}"
+        course_titles = [
+            meta.get("course_title", "unknown") for meta in results.metadata
+        ]
+        lesson_nums = [meta.get("lesson_number") for meta in results.metadata]
+        pairs: list[tuple[str, int | None]] = list(
+            zip(course_titles, lesson_nums, strict=True)
+        )
 
-            # Retrieve lesson link from vector store
-            link = None
-            if lesson_num is not None:
-                link = self.store.get_lesson_link(course_title, lesson_num)
+        # Build source text, also used as the context header
+        source_texts = [
+            title if num is None else f"{title} - Lesson {num}" for title, num in pairs
+        ]
 
-            sources.append({"text": source_text, "link": link})
-            formatted.append(f"{header}\n{doc}")
+        # Retrieve lesson links from vector store in a single lookup
+        links = self.store.get_lesson_links(
+            [(title, num) for title, num in pairs if num is not None]
+        )
 
-        # Store sources for retrieval
-        self.last_sources = sources
+        # Record sources for retrieval by the UI
+        if context is not None:
+            context.sources.extend(
+                {"text": text, "link": None if num is None else links.get((title, num))}
+                for text, (title, num) in zip(source_texts, pairs, strict=True)
+            )
 
-        return "\n\n".join(formatted)
+        return "\n\n".join(
+            f"[{text}]\n{doc}"
+            for text, doc in zip(source_texts, results.documents, strict=False)
+        )
 
 
 class CourseOutlineTool(Tool):
     """Tool for retrieving course outline with lesson list"""
 
+    # Maximum cached course names/outlines before the caches are reset
+    CACHE_SIZE = 256
+
     def __init__(self, vector_store: VectorStore) -> None:
         self.store = vector_store
-        self.last_sources = []  # Track sources for UI
 
-    def get_tool_definition(self) -> dict[str, Any]:
-        """Return Anthropic tool definition for this tool"""
-        return {
+        # Lookups are pure for a given catalog version, so cache them per tool
+        self._title_cache: dict[str, str] = {}
+        self._metadata_cache: dict[str, dict[str, Any]] = {}
+        self._cache_version = vector_store.catalog_version
+
+        # Definition never changes, so build it once per tool
+        self._definition = {
             "name": "get_course_outline",
             "description": "Get the complete outline of a course including title, link, and all lessons. Use this for questions about course structure, table of contents, or what topics a course covers.",
             "input_schema": {
@@ -146,66 +179,102 @@ class CourseOutlineTool(Tool):
             },
         }
 
-    def execute(self, course_name: str) -> str:
+    def get_tool_definition(self) -> dict[str, Any]:
+        """Return Anthropic tool definition for this tool"""
+        return self._definition
+
+    def execute(
+        self, course_name: str, context: SearchContext | None = None
+    ) -> ToolResult:
         """
         Execute the outline tool to get course structure.
 
         Args:
             course_name: Course to get outline for (supports fuzzy matching)
+            context: Request context that receives the course source
 
         Returns:
             Formatted course outline or error message
         """
+        self._sync_cache()
+
         # Resolve course name using semantic search
         resolved_title = self._resolve_course_name(course_name)
         if not resolved_title:
-            return f"No course found matching '{course_name}'."
+            return ToolResult(f"No course found matching '{course_name}'.")
 
         # Get full course metadata
         course_data = self._get_course_metadata(resolved_title)
         if not course_data:
-            return f"Could not retrieve metadata for course '{resolved_title}'."
+            return ToolResult(
+                f"Could not retrieve metadata for course '{resolved_title}'.",
+                is_error=True,
+            )
 
         # Format and return the outline
-        return self._format_outline(course_data)
+        return ToolResult(self._format_outline(course_data, context))
+
+    def _sync_cache(self) -> None:
+        """Drop cached lookups once the catalog changes or the caches fill up"""
+        version = self.store.catalog_version
+        if (
+            version != self._cache_version
+            or len(self._title_cache) >= self.CACHE_SIZE
+            or len(self._metadata_cache) >= self.CACHE_SIZE
+        ):
+            self._title_cache.clear()
+            self._metadata_cache.clear()
+            self._cache_version = version
 
     def _resolve_course_name(self, course_name: str) -> str | None:
         """Use vector search to find best matching course by name"""
+        if course_name in self._title_cache:
+            return self._title_cache[course_name]
+
         try:
             results = self.store.course_catalog.query(
                 query_texts=[course_name], n_results=1
             )
 
             if results["documents"][0] and results["metadatas"][0]:
-                return results["metadatas"][0][0]["title"]
+                title = results["metadatas"][0][0]["title"]
+                self._title_cache[course_name] = title
+                return title
         except Exception as e:
-            print(f"Error resolving course name: {e}")
+            logger.error("Error resolving course name: %s", e)
 
         return None
 
     def _get_course_metadata(self, course_title: str) -> dict[str, Any] | None:
         """Get full course metadata by title"""
+        if course_title in self._metadata_cache:
+            return self._metadata_cache[course_title]
+
         try:
             results = self.store.course_catalog.get(ids=[course_title])
             if results and "metadatas" in results and results["metadatas"]:
                 metadata = results["metadatas"][0]
                 # Parse lessons JSON
                 if "lessons_json" in metadata:
-                    metadata["lessons"] = json.loads(metadata["lessons_json"])
+                    metadata["lessons"] = orjson.loads(metadata["lessons_json"])
+                self._metadata_cache[course_title] = metadata
                 return metadata
         except Exception as e:
-            print(f"Error getting course metadata: {e}")
+            logger.error("Error getting course metadata: %s", e)
 
         return None
 
-    def _format_outline(self, course_data: dict[str, Any]) -> str:
+    def _format_outline(
+        self, course_data: dict[str, Any], context: SearchContext | None
+    ) -> str:
         """Format course outline with lessons"""
         title = course_data.get("title", "Unknown Course")
         course_link = course_data.get("course_link", "")
         lessons = course_data.get("lessons", [])
 
-        # Store source for UI
-        self.last_sources = [{"text": title, "link": course_link}]
+        # Record source for UI
+        if context is not None:
+            context.sources.append({"text": title, "link": course_link})
 
         # Build formatted output
         lines = [f"Course: {title}"]
@@ -226,11 +295,113 @@ class CourseOutlineTool(Tool):
         return "\n".join(lines)
 
 
+class BatchTool(Tool):
+    """Tool that runs several other tool calls at once in a single tool_use"""
+
+    # Most worker threads one call runs its wrapped invocations on
+    MAX_WORKERS = 4
+
+    def __init__(self, tool_manager: "ToolManager") -> None:
+        self.tool_manager = tool_manager
+
+        # Definition never changes, so build it once per tool
+        self._definition = {
+            "name": "batch_tool",
+            "description": "Invoke multiple other tool calls simultaneously. Use this when a question needs several independent searches or outlines, e.g. comparing lessons or courses.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "invocations": {
+                        "type": "array",
+                        "description": "The tool calls to make",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "name": {
+                                    "type": "string",
+                                    "description": "The name of the tool to invoke",
+                                },
+                                "arguments": {
+                                    "type": "object",
+                                    "description": "The arguments to the tool",
+                                },
+                            },
+                            "required": ["name", "arguments"],
+                        },
+                    }
+                },
+                "required": ["invocations"],
+            },
+        }
+
+    def get_tool_definition(self) -> dict[str, Any]:
+        """Return Anthropic tool definition for this tool"""
+        return self._definition
+
+    def execute(
+        self,
+        invocations: list[dict[str, Any]],
+        context: SearchContext | None = None,
+    ) -> ToolResult:
+        """
+        Run the wrapped tool calls concurrently and combine their output.
+
+        Args:
+            invocations: {"name": ..., "arguments": {...}} tool calls
+            context: Request context shared by the wrapped tools
+
+        Returns:
+            Each call's output in invocation order, flagged as an error only
+            when every call failed; any failed call marks the context failed
+        """
+        if not invocations:
+            return ToolResult("No tool invocations given", is_error=True)
+
+        def invoke(invocation: dict[str, Any]) -> ToolResult:
+            name = invocation.get("name", "")
+            if name == self._definition["name"]:
+                return ToolResult("batch_tool cannot be nested", is_error=True)
+            try:
+                arguments = invocation.get("arguments") or {}
+                # Claude sometimes sends the arguments as a JSON string
+                if isinstance(arguments, str):
+                    arguments = orjson.loads(arguments)
+                return self.tool_manager.execute_tool(
+                    name, context=context, **arguments
+                )
+            except Exception as e:
+                logger.error("Batched call to %s failed: %s", name, e)
+                return ToolResult(f"Tool execution failed: {e!s}", is_error=True)
+
+        # A pool per call, so concurrent requests' batches never queue
+        # behind each other
+        with ThreadPoolExecutor(
+            max_workers=min(len(invocations), self.MAX_WORKERS),
+            thread_name_prefix="batch_tool",
+        ) as executor:
+            results = list(executor.map(invoke, invocations))
+
+        # Even a partly failed batch gives an answer not worth caching
+        if context is not None and any(r.is_error for r in results):
+            context.failed = True
+
+        sections = []
+        for invocation, result in zip(invocations, results, strict=True):
+            label = invocation.get("name", "")
+            if result.is_error:
+                label += " (error)"
+            sections.append(f"[{label}]\n{result.content}")
+        return ToolResult(
+            "\n\n".join(sections), is_error=all(r.is_error for r in results)
+        )
+
+
 class ToolManager:
     """Manages available tools for the AI"""
 
     def __init__(self) -> None:
-        self.tools = {}
+        self.tools: dict[str, Tool] = {}
+        self._definitions_cache: list | None = None  # Rebuilt after registration
 
     def register_tool(self, tool: Tool) -> None:
         """Register any tool that implements the Tool interface"""
@@ -240,28 +411,23 @@ class ToolManager:
             msg = "Tool must have a 'name' in its definition"
             raise ValueError(msg)
         self.tools[tool_name] = tool
+        self._definitions_cache = None
 
     def get_tool_definitions(self) -> list:
         """Get all tool definitions for Anthropic tool calling"""
-        return [tool.get_tool_definition() for tool in self.tools.values()]
-
-    def execute_tool(self, tool_name: str, **kwargs: Any) -> str:
-        """Execute a tool by name with given parameters"""
+        if self._definitions_cache is None:
+            self._definitions_cache = [
+                tool.get_tool_definition() for tool in self.tools.values()
+            ]
+        return self._definitions_cache
+
+    def execute_tool(
+        self, tool_name: str, context: SearchContext | None = None, **kwargs: Any
+    ) -> ToolResult:
+        """Execute a tool by name, recording its sources in the request context"""
         if tool_name not in self.tools:
-            return f"Tool '{tool_name}' not found"
-
-        return self.tools[tool_name].execute(**kwargs)
-
-    def get_last_sources(self) -> list:
-        """Get sources from the last search operation"""
-        # Check all tools for last_sources attribute
-        for tool in self.tools.values():
-            if hasattr(tool, "last_sources") and tool.last_sources:
-                return tool.last_sources
-        return []
-
-    def reset_sources(self) -> None:
-        """Reset sources from all tools that track sources"""
-        for tool in self.tools.values():
-            if hasattr(tool, "last_sources"):
-                tool.last_sources = []
+            return ToolResult(f"Tool '{tool_name}' not found", is_error=True)
+        if context is not None and context.cancelled:
+            return ToolResult("Request was cancelled", is_error=True)
+
+        return self.tools[tool_name].execute(context=context, **kwargs)
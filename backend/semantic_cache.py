@@ -0,0 +1,147 @@
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+from cachetools import LRUCache
+from numpy.typing import ArrayLike
+
+
+@dataclass
+class CachedAnswer:
+    """An answer stored in the semantic cache"""
+
+    row: int  # Row of the query embedding in the cache matrix
+    answer: str
+    sources: list[dict[str, Any]]
+
+
+class _AnswerLRU(LRUCache):
+    """LRUCache that hands evicted answers back so their row can be reused"""
+
+    def __init__(self, maxsize: int, on_evict: Callable[[CachedAnswer], None]) -> None:
+        super().__init__(maxsize)
+        self._on_evict = on_evict
+
+    def popitem(self) -> tuple[int, CachedAnswer]:
+        key, entry = super().popitem()
+        self._on_evict(entry)
+        return key, entry
+
+
+class SemanticCache:
+    """
+    Bounded cache of answers looked up by query embedding similarity.
+
+    Lookups first narrow to entries asked with the same conversation history,
+    then pick the most similar stored query by cosine similarity.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Callable[[list[str]], Sequence[ArrayLike]],
+        maxsize: int = 1024,
+        threshold: float = 0.95,
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.maxsize = maxsize
+        self.threshold = threshold
+
+        # Answers keyed by matrix row, evicted least recently used first
+        self._answers = _AnswerLRU(maxsize, self._release_row)
+
+        # Unit-length query embeddings, allocated once the dimension is known
+        self._vectors: np.ndarray | None = None
+        self._contexts = np.zeros(maxsize, dtype=np.int64)
+        self._occupied = np.zeros(maxsize, dtype=bool)
+        self._free_rows = list(range(maxsize - 1, -1, -1))
+
+    def embed(self, query: str) -> np.ndarray:
+        """
+        Compute the unit-length embedding used to look up a query.
+
+        Args:
+            query: User's question
+
+        Returns:
+            Normalized query embedding
+        """
+        vector = np.asarray(self.embedding_function([query])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self, embedding: np.ndarray, history: str | None
+    ) -> tuple[str, list[dict[str, Any]]] | None:
+        """
+        Find a cached answer for a similar query asked with the same history.
+
+        Args:
+            embedding: Normalized query embedding from embed()
+            history: Conversation history the query was asked with
+
+        Returns:
+            Tuple of (answer, sources) on a hit, otherwise None
+        """
+        if self._vectors is None:
+            return None
+
+        candidates = self._occupied & (self._contexts == self._fingerprint(history))
+        if not candidates.any():
+            return None
+
+        # Vectors are unit length, so the dot product is the cosine similarity
+        similarities = np.where(candidates, self._vectors @ embedding, -np.inf)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+
+        entry = self._answers[best]  # Marks the entry as recently used
+        return entry.answer, list(entry.sources)
+
+    def store(
+        self,
+        embedding: np.ndarray,
+        history: str | None,
+        answer: str,
+        sources: list[dict[str, Any]],
+    ) -> None:
+        """
+        Cache an answer, evicting the least recently used one when full.
+
+        Args:
+            embedding: Normalized query embedding from embed()
+            history: Conversation history the query was asked with
+            answer: Generated response
+            sources: Sources returned with the response
+        """
+        if self._vectors is None:
+            self._vectors = np.zeros((self.maxsize, embedding.shape[0]), np.float32)
+
+        # Evict before claiming a row so a full cache always has one free
+        if len(self._answers) >= self.maxsize:
+            self._answers.popitem()
+
+        row = self._free_rows.pop()
+        self._vectors[row] = embedding
+        self._contexts[row] = self._fingerprint(history)
+        self._occupied[row] = True
+        self._answers[row] = CachedAnswer(row=row, answer=answer, sources=sources)
+
+    def clear(self) -> None:
+        """Remove every cached answer"""
+        # Clearing evicts entries one by one, which frees their rows
+        self._answers.clear()
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+    def _release_row(self, entry: CachedAnswer) -> None:
+        """Free the matrix row of an evicted answer"""
+        self._occupied[entry.row] = False
+        self._free_rows.append(entry.row)
+
+    @staticmethod
+    def _fingerprint(history: str | None) -> int:
+        """Reduce conversation history to a comparable key"""
+        return hash(history or "")
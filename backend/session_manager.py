@@ -12,8 +12,11 @@ class Message:
 class SessionManager:
     """Manages conversation sessions and message history"""
 
-    def __init__(self, max_history: int = 5) -> None:
+    def __init__(self, max_history: int = 5, history_buffer: int = 0) -> None:
         self.max_history = max_history
+        # Extra exchanges allowed before trimming, so history is cut in one
+        # batch and its prefix stays identical across several turns
+        self.history_buffer = history_buffer
         self.sessions: dict[str, list[Message]] = {}
         self.session_counter = 0
 
@@ -29,14 +32,15 @@ class SessionManager:
         if session_id not in self.sessions:
             self.sessions[session_id] = []
 
-        message = Message(role=role, content=content)
-        self.sessions[session_id].append(message)
-
-        # Keep conversation history within limits
-        if len(self.sessions[session_id]) > self.max_history * 2:
-            self.sessions[session_id] = self.sessions[session_id][
-                -self.max_history * 2 :
-            ]
+        messages = self.sessions[session_id]
+        messages.append(Message(role=role, content=content))
+
+        # Keep conversation history within limits, dropping buffered
+        # exchanges together once the buffer is exceeded
+        if len(messages) > (self.max_history + self.history_buffer) * 2:
+            # Drop whole exchanges so history still opens with a user turn
+            excess = len(messages) - self.max_history * 2
+            del messages[: excess + excess % 2]
 
     def add_exchange(
         self, session_id: str, user_message: str, assistant_message: str
@@ -1,17 +1,21 @@
 import os
+import re
 import sys
+from types import SimpleNamespace
 from unittest.mock import MagicMock
 
+import httpx
 import pytest
-from fastapi.testclient import TestClient
 
 # Add backend to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
+from ai_generator import AIGenerator, AsyncAIGenerator
 from app import create_app
 from config import Config
 from models import Course, CourseChunk, Lesson
 from rag_system import RAGSystem
+from search_tools import CourseSearchTool, ToolResult
 from vector_store import SearchResults
 
 
@@ -24,6 +28,8 @@ def test_config():
     config.MAX_HISTORY = 2
     config.CHUNK_SIZE = 800
     config.CHUNK_OVERLAP = 100
+    config.SEMANTIC_CACHE_SIZE = 0  # Tests opt in to caching explicitly
+    config.RESPONSE_CACHE_SIZE = 0
     return config
 
 
@@ -68,9 +74,9 @@ def sample_course_chunks(sample_course):
     ]
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_search_results():
-    """Sample search results from vector store"""
+    """Sample search results from vector store (shared; tests only read it)"""
     return SearchResults(
         documents=[
             "Lesson 1 content: Prompt engineering is the art of crafting effective prompts.",
@@ -93,15 +99,15 @@ def sample_search_results():
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def empty_search_results():
-    """Empty search results"""
+    """Empty search results (shared; tests only read it)"""
     return SearchResults(documents=[], metadata=[], distances=[], error=None)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def error_search_results():
-    """Search results with error"""
+    """Search results with error (shared; tests only read it)"""
     return SearchResults(
         documents=[], metadata=[], distances=[], error="Database connection failed"
     )
@@ -112,58 +118,17 @@ def mock_vector_store(sample_search_results):
     """Mock VectorStore with configurable behavior"""
     mock = MagicMock()
     mock.search.return_value = sample_search_results
-    mock.get_lesson_link.return_value = "https://example.com/lesson1"
+    mock.get_lesson_links.side_effect = lambda lessons: dict.fromkeys(
+        lessons, "https://example.com/lesson1"
+    )
     mock.get_course_count.return_value = 5
+    mock.catalog_version = 0
     mock.get_existing_course_titles.return_value = [
         "Introduction to Prompt Engineering"
     ]
     return mock
 
 
-@pytest.fixture
-def mock_anthropic_client():
-    """Mock Anthropic client for API calls"""
-    return MagicMock()
-
-
-@pytest.fixture
-def mock_tool_use_response():
-    """Mock response from Anthropic with tool use"""
-    mock = MagicMock()
-    mock.stop_reason = "tool_use"
-
-    # Create mock tool use content block
-    tool_use_block = MagicMock()
-    tool_use_block.type = "tool_use"
-    tool_use_block.name = "search_course_content"
-    tool_use_block.id = "toolu_123456"
-    tool_use_block.input = {
-        "query": "What is prompt engineering?",
-        "course_name": None,
-        "lesson_number": None,
-    }
-
-    mock.content = [tool_use_block]
-    return mock
-
-
-@pytest.fixture
-def mock_text_response():
-    """Mock text-only response from Anthropic"""
-    mock = MagicMock()
-    mock.stop_reason = "end_turn"
-
-    # Create mock text content block
-    text_block = MagicMock()
-    text_block.type = "text"
-    text_block.text = (
-        "Prompt engineering is the art of crafting effective prompts for AI systems."
-    )
-
-    mock.content = [text_block]
-    return mock
-
-
 @pytest.fixture
 def mock_session_manager():
     """Mock SessionManager"""
@@ -178,8 +143,7 @@ def mock_session_manager():
 def mock_tool_manager():
     """Mock ToolManager"""
     mock = MagicMock()
-    mock.execute_tool.return_value = "Search results here"
-    mock.get_last_sources.return_value = []
+    mock.execute_tool.return_value = ToolResult("Search results here")
     mock.get_tool_definitions.return_value = [
         {"name": "search_course_content", "description": "Search course content"},
         {"name": "get_course_outline", "description": "Get course outline"},
@@ -187,6 +151,336 @@ def mock_tool_manager():
     return mock
 
 
+@pytest.fixture
+def make_search_tool(mock_vector_store):
+    """Factory for CourseSearchTools whose vector store returns the given results"""
+
+    def build(results):
+        mock_vector_store.search.return_value = results
+        return CourseSearchTool(mock_vector_store)
+
+    return build
+
+
+class ScriptedToolManager:
+    """
+    ToolManager stand-in that returns scripted results per tool name.
+
+    Each tool's results come back in the order that tool is called, so tests
+    do not depend on the order different tools run in. Strings are wrapped
+    in ToolResult and scripted exceptions are raised. Every call is recorded
+    in calls as a (tool_name, kwargs) pair.
+    """
+
+    def __init__(self, script):
+        self._script = {name: list(results) for name, results in script.items()}
+        self.calls = []
+
+    def execute_tool(self, tool_name, **kwargs):
+        self.calls.append((tool_name, kwargs))
+        result = self._script[tool_name].pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return ToolResult(result) if isinstance(result, str) else result
+
+
+@pytest.fixture(scope="session")
+def make_tool_manager():
+    """Factory for ScriptedToolManagers from {tool_name: [results]}"""
+    return ScriptedToolManager
+
+
+# ============================================================================
+# ANTHROPIC API FIXTURES
+# ============================================================================
+
+
+def _tool_block(tool_name="search_course_content", tool_id="tool_123", tool_input=None):
+    """Build a tool_use content block"""
+    return SimpleNamespace(
+        type="tool_use",
+        name=tool_name,
+        id=tool_id,
+        input={"query": "test"} if tool_input is None else tool_input,
+    )
+
+
+def _tool_use_response(*blocks, **block_fields):
+    """Build a tool_use response from blocks, or from one block's fields"""
+    return SimpleNamespace(
+        stop_reason="tool_use",
+        content=list(blocks) or [_tool_block(**block_fields)],
+    )
+
+
+def _text_response(text="Answer"):
+    """Build an end_turn response with a single text block"""
+    return SimpleNamespace(
+        stop_reason="end_turn",
+        content=[SimpleNamespace(type="text", text=text)],
+    )
+
+
+@pytest.fixture(scope="session")
+def make_tool_block():
+    """Factory for tool_use content blocks"""
+    return _tool_block
+
+
+@pytest.fixture(scope="session")
+def make_tool_use_response():
+    """Factory for Anthropic responses that request tool use"""
+    return _tool_use_response
+
+
+@pytest.fixture(scope="session")
+def make_text_response():
+    """Factory for Anthropic responses that end with text"""
+    return _text_response
+
+
+class FakeAnthropicClient:
+    """
+    Stand-in for anthropic.Anthropic that replays scripted responses.
+
+    Each scripted response answers one call, in order, so an unexpected
+    extra call fails with its number once the script runs out.
+    The keyword arguments of every call are kept in calls, with the
+    messages list copied as it was when sent.
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.calls = []
+        self.messages = SimpleNamespace(create=self._create)
+
+    def script(self, *responses):
+        """Set the responses returned by the following calls"""
+        self.responses = list(responses)
+
+    def _next_response(self, kwargs):
+        self.calls.append({**kwargs, "messages": list(kwargs["messages"])})
+        if not self.responses:
+            msg = f"messages call #{len(self.calls)} has no scripted response"
+            raise AssertionError(msg)
+        return self.responses.pop(0)
+
+    def _create(self, **kwargs):
+        return self._next_response(kwargs)
+
+
+class FakeMessageStream:
+    """Async message stream that replays a response's blocks as SDK events"""
+
+    def __init__(self, response):
+        self.response = response
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        # Text arrives word by word; each block ends with content_block_stop
+        for block in self.response.content:
+            if block.type == "text":
+                for chunk in re.findall(r"\s*\S+", block.text):
+                    yield SimpleNamespace(type="text", text=chunk)
+            yield SimpleNamespace(type="content_block_stop", content_block=block)
+
+    async def get_final_message(self):
+        return self.response
+
+
+async def _aiter(items):
+    """Async iterator over a list, like the SDK's JSONL batch results"""
+    for item in items:
+        yield item
+
+
+class FakeAsyncAnthropicClient(FakeAnthropicClient):
+    """
+    FakeAnthropicClient with an awaitable create, streaming and message batches.
+
+    Batch requests are answered from the script in submission order, and a
+    scripted exception makes its request error; each batch reports
+    in_progress once so callers poll it. The result entries of every batch
+    are kept in batches and the ids of canceled batches in canceled.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+        self.canceled = []
+        self.messages = SimpleNamespace(
+            create=self._acreate,
+            stream=self._stream,
+            batches=SimpleNamespace(
+                create=self._create_batch,
+                retrieve=self._retrieve_batch,
+                cancel=self._cancel_batch,
+                results=self._batch_results,
+            ),
+        )
+
+    async def _acreate(self, **kwargs):
+        return self._next_response(kwargs)
+
+    def _stream(self, **kwargs):
+        return FakeMessageStream(self._next_response(kwargs))
+
+    def _batch_result(self, params):
+        response = self._next_response(params)
+        if isinstance(response, Exception):
+            return SimpleNamespace(type="errored", error=response)
+        return SimpleNamespace(type="succeeded", message=response)
+
+    async def _create_batch(self, requests):
+        self.batches.append(
+            [
+                SimpleNamespace(
+                    custom_id=request["custom_id"],
+                    result=self._batch_result(request["params"]),
+                )
+                for request in requests
+            ]
+        )
+        return SimpleNamespace(
+            id=len(self.batches) - 1, processing_status="in_progress"
+        )
+
+    async def _retrieve_batch(self, batch_id):
+        return SimpleNamespace(id=batch_id, processing_status="ended")
+
+    async def _cancel_batch(self, batch_id):
+        self.canceled.append(batch_id)
+        return SimpleNamespace(id=batch_id, processing_status="canceling")
+
+    async def _batch_results(self, batch_id):
+        return _aiter(self.batches[batch_id])
+
+
+@pytest.fixture
+def fake_anthropic_client():
+    """Fake Anthropic client shared by the generator and the test"""
+    return FakeAnthropicClient()
+
+
+@pytest.fixture
+def fake_async_anthropic_client():
+    """Fake async Anthropic client shared by the generator and the test"""
+    return FakeAsyncAnthropicClient()
+
+
+@pytest.fixture
+def make_client(fake_anthropic_client):
+    """Script the fake client's responses and return it"""
+
+    def factory(*responses):
+        fake_anthropic_client.script(*responses)
+        return fake_anthropic_client
+
+    return factory
+
+
+@pytest.fixture
+def make_async_client(fake_async_anthropic_client):
+    """Script the fake async client's responses and return it"""
+
+    def factory(*responses):
+        fake_async_anthropic_client.script(*responses)
+        return fake_async_anthropic_client
+
+    return factory
+
+
+@pytest.fixture
+def anthropic_mock(monkeypatch):
+    """MagicMock client handed out by anthropic.Anthropic() for the test"""
+    client = MagicMock()
+    monkeypatch.setattr("anthropic.Anthropic", lambda **_kwargs: client)
+    return client
+
+
+@pytest.fixture
+def rag_patches(mocker, anthropic_mock):  # noqa: ARG001 - patches Anthropic
+    """
+    Patch RAGSystem's collaborators so it builds without storage or network.
+
+    anthropic.Anthropic hands out anthropic_mock. The VectorStore,
+    DocumentProcessor and anthropic.AsyncAnthropic class mocks are returned
+    so tests can set their return values before building a RAGSystem.
+    """
+    return SimpleNamespace(
+        vector_store=mocker.patch("rag_system.VectorStore"),
+        document_processor=mocker.patch("rag_system.DocumentProcessor"),
+        async_anthropic=mocker.patch("anthropic.AsyncAnthropic"),
+    )
+
+
+class _NoClientMixin:
+    """Skips building a real SDK client so a fake one can be installed"""
+
+    def _create_client(self, _api_key, _default_headers):
+        return None
+
+
+class OfflineAIGenerator(_NoClientMixin, AIGenerator):
+    """AIGenerator that leaves client installation to the test"""
+
+
+class OfflineAsyncAIGenerator(_NoClientMixin, AsyncAIGenerator):
+    """AsyncAIGenerator that leaves client installation to the test"""
+
+    BATCH_POLL_INTERVAL = 0  # Fake batches end as soon as they are polled
+
+
+@pytest.fixture
+def generator_factory(fake_anthropic_client):
+    """Factory for AIGenerators with a custom model, backed by the fake client"""
+
+    def factory(model="claude-sonnet-4"):
+        generator = OfflineAIGenerator(api_key="test-key", model=model)
+        generator.client = fake_anthropic_client
+        return generator
+
+    return factory
+
+
+# One generator of each kind serves the whole session the way the app's single
+# RAGSystem does. Each test installs its own client and clears the memoized
+# cacheable tool list, the only state a generator keeps between queries
+
+
+@pytest.fixture(scope="session")
+def shared_generator():
+    """AIGenerator built once and reused across tests"""
+    return OfflineAIGenerator(api_key="test-key", model="claude-sonnet-4")
+
+
+@pytest.fixture(scope="session")
+def shared_async_generator():
+    """AsyncAIGenerator built once and reused across tests"""
+    return OfflineAsyncAIGenerator(api_key="test-key", model="claude-sonnet-4")
+
+
+@pytest.fixture
+def generator(shared_generator, fake_anthropic_client):
+    """AIGenerator backed by the fake client"""
+    shared_generator.client = fake_anthropic_client
+    shared_generator._cached_tools_memo = (None, [])
+    return shared_generator
+
+
+@pytest.fixture
+def async_generator(shared_async_generator, fake_async_anthropic_client):
+    """AsyncAIGenerator backed by the fake async client"""
+    shared_async_generator.client = fake_async_anthropic_client
+    shared_async_generator._cached_tools_memo = (None, [])
+    return shared_async_generator
+
+
 # ============================================================================
 # API TESTING FIXTURES
 # ============================================================================
@@ -198,7 +492,7 @@ def mock_rag_system(mock_vector_store, mock_session_manager, mock_tool_manager):
     mock_rag = MagicMock(spec=RAGSystem)
 
     # Configure default responses
-    mock_rag.query.return_value = (
+    mock_rag.aquery.return_value = (
         "This is a test response about prompt engineering.",
         [
             {
@@ -223,6 +517,13 @@ def mock_rag_system(mock_vector_store, mock_session_manager, mock_tool_manager):
         ],
     }
 
+    mock_rag.ingestion_status = {
+        "state": "complete",
+        "courses": 3,
+        "chunks": 42,
+        "error": None,
+    }
+
     mock_rag.session_manager = mock_session_manager
     mock_rag.vector_store = mock_vector_store
     mock_rag.tool_manager = mock_tool_manager
@@ -232,27 +533,28 @@ def mock_rag_system(mock_vector_store, mock_session_manager, mock_tool_manager):
 
 @pytest.fixture
 def test_app(mock_rag_system):
-    """Create FastAPI test application with mocked dependencies"""
-    # Create app without static files and startup events
-    app = create_app(mount_static=False, skip_startup=True)
+    """Create FastAPI test application serving the mocked RAG system"""
+    # Create app without static files and startup work
+    return create_app(mount_static=False, skip_startup=True, rag_system=mock_rag_system)
 
-    # Override the global rag_system with our mock
-    import app as app_module
 
-    original_rag = app_module.rag_system
-    app_module.rag_system = mock_rag_system
-
-    yield app
-
-    # Cleanup: restore original
-    app_module.rag_system = original_rag
+@pytest.fixture
+async def aclient(test_app):
+    """httpx AsyncClient calling the app in-process on the test's event loop"""
+    transport = httpx.ASGITransport(app=test_app)
+    async with (
+        test_app.router.lifespan_context(test_app),
+        httpx.AsyncClient(transport=transport, base_url="http://test") as client,
+    ):
+        yield client
 
 
 @pytest.fixture
-def client(test_app):
-    """FastAPI TestClient for making HTTP requests in tests"""
-    with TestClient(test_app) as test_client:
-        yield test_client
+def failing_rag(test_app, aclient, monkeypatch):  # noqa: ARG001 - swap after startup
+    """Bare MagicMock swapped in as the app's RAG system for error-path tests"""
+    mock_rag = MagicMock()
+    monkeypatch.setattr(test_app.state, "rag_system", mock_rag)
+    return mock_rag
 
 
 @pytest.fixture
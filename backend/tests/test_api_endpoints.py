@@ -1,24 +1,33 @@
 """
 API Endpoint Tests for FastAPI application
-Tests cover: POST /api/query, GET /api/courses, DELETE /api/session/{session_id}
-Uses FastAPI TestClient with mocked RAGSystem dependencies
+Tests cover: POST /api/query, POST /api/query/batch, POST /api/query/stream,
+GET /api/courses, GET /api/health, DELETE /api/session/{session_id}, POST /api/cache/clear
+Requests go through an httpx AsyncClient over ASGITransport, with mocked RAGSystem
+dependencies; the lifespan tests use FastAPI TestClient to run real startup and shutdown
 """
 
-from unittest.mock import patch
+import asyncio
+import json
+import logging
+import time
+from unittest.mock import AsyncMock, patch
 
 import pytest
+from app import create_app
 from fastapi import status
+from fastapi.testclient import TestClient
+
+pytestmark = pytest.mark.api
 
 # ============================================================================
 # POST /api/query ENDPOINT TESTS
 # ============================================================================
 
 
-@pytest.mark.api
-def test_query_endpoint_success(client, mock_rag_system, valid_query_request):
+async def test_query_endpoint_success(aclient, mock_rag_system, valid_query_request):
     """Test successful query with session ID"""
     # Execute
-    response = client.post("/api/query", json=valid_query_request)
+    response = await aclient.post("/api/query", json=valid_query_request)
 
     # Verify response
     assert response.status_code == status.HTTP_200_OK
@@ -30,21 +39,20 @@ def test_query_endpoint_success(client, mock_rag_system, valid_query_request):
     assert data["session_id"] == "test_session_123"
 
     # Verify RAGSystem called correctly
-    mock_rag_system.query.assert_called_once_with(
+    mock_rag_system.aquery.assert_awaited_once_with(
         "What is prompt engineering?", "test_session_123"
     )
 
 
-@pytest.mark.api
-def test_query_endpoint_creates_session_when_missing(
-    client, mock_rag_system, query_request_without_session
+async def test_query_endpoint_creates_session_when_missing(
+    aclient, mock_rag_system, query_request_without_session
 ):
     """Test that endpoint creates session ID if not provided"""
     # Setup: mock session creation
     mock_rag_system.session_manager.create_session.return_value = "auto_session_456"
 
     # Execute
-    response = client.post("/api/query", json=query_request_without_session)
+    response = await aclient.post("/api/query", json=query_request_without_session)
 
     # Verify
     assert response.status_code == status.HTTP_200_OK
@@ -55,11 +63,10 @@ def test_query_endpoint_creates_session_when_missing(
     assert data["session_id"] == "auto_session_456"
 
 
-@pytest.mark.api
-def test_query_endpoint_validation_error(client, invalid_query_request):
+async def test_query_endpoint_validation_error(aclient, invalid_query_request):
     """Test validation error for missing required field"""
     # Execute
-    response = client.post("/api/query", json=invalid_query_request)
+    response = await aclient.post("/api/query", json=invalid_query_request)
 
     # Verify 422 validation error
     assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
@@ -70,43 +77,37 @@ def test_query_endpoint_validation_error(client, invalid_query_request):
     assert isinstance(data["detail"], list)
 
 
-@pytest.mark.api
 @pytest.mark.usefixtures("mock_rag_system")
-def test_query_endpoint_empty_query(client, empty_query_request):
+async def test_query_endpoint_empty_query(aclient, empty_query_request):
     """Test behavior with empty query string"""
     # Execute
-    response = client.post("/api/query", json=empty_query_request)
+    response = await aclient.post("/api/query", json=empty_query_request)
 
     # Should still process (empty string is valid string type)
     assert response.status_code == status.HTTP_200_OK
 
 
-@pytest.mark.api
-@pytest.mark.usefixtures("test_app")
-def test_query_endpoint_handles_rag_exception(client):
+async def test_query_endpoint_handles_rag_exception(aclient, failing_rag):
     """Test error handling when RAGSystem raises exception"""
-    # Patch the global rag_system to raise an exception
-    with patch("app.rag_system") as mock_rag:
-        mock_rag.query.side_effect = Exception("Vector store unavailable")
-        mock_rag.session_manager.create_session.return_value = "session_err"
+    failing_rag.aquery.side_effect = Exception("Vector store unavailable")
+    failing_rag.session_manager.create_session.return_value = "session_err"
 
-        response = client.post(
-            "/api/query", json={"query": "Test query", "session_id": "test_session"}
-        )
+    response = await aclient.post(
+        "/api/query", json={"query": "Test query", "session_id": "test_session"}
+    )
 
-        # Should return 500 error
-        assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+    # Should return 500 error
+    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
 
-        data = response.json()
-        assert "detail" in data
-        assert "Vector store unavailable" in data["detail"]
+    data = response.json()
+    assert "detail" in data
+    assert "Vector store unavailable" in data["detail"]
 
 
-@pytest.mark.api
-def test_query_endpoint_with_sources(client, mock_rag_system):
+async def test_query_endpoint_with_sources(aclient, mock_rag_system):
     """Test that sources are properly returned in response"""
     # Configure mock to return specific sources
-    mock_rag_system.query.return_value = (
+    mock_rag_system.aquery.return_value = (
         "Response with sources",
         [
             {"text": "Course 1 - Lesson 1", "link": "https://example.com/1"},
@@ -114,7 +115,7 @@ def test_query_endpoint_with_sources(client, mock_rag_system):
         ],
     )
 
-    response = client.post(
+    response = await aclient.post(
         "/api/query", json={"query": "Test with sources", "session_id": "test_session"}
     )
 
@@ -127,29 +128,195 @@ def test_query_endpoint_with_sources(client, mock_rag_system):
     assert data["sources"][0]["link"] == "https://example.com/1"
 
 
-@pytest.mark.api
-def test_query_endpoint_preserves_conversation_context(client, mock_rag_system):
-    """Test that multiple queries in same session maintain context"""
+async def test_query_endpoint_preserves_conversation_context(aclient, mock_rag_system):
+    """Test that concurrent queries in the same session both reach the RAG system"""
     session_id = "context_session_789"
 
-    # First query
-    response1 = client.post(
-        "/api/query",
-        json={"query": "What is prompt engineering?", "session_id": session_id},
+    # Send both queries at once so the handler cannot rely on running serially
+    response1, response2 = await asyncio.gather(
+        aclient.post(
+            "/api/query",
+            json={"query": "What is prompt engineering?", "session_id": session_id},
+        ),
+        aclient.post(
+            "/api/query", json={"query": "Can you elaborate?", "session_id": session_id}
+        ),
     )
     assert response1.status_code == status.HTTP_200_OK
-
-    # Second query in same session
-    response2 = client.post(
-        "/api/query", json={"query": "Can you elaborate?", "session_id": session_id}
-    )
     assert response2.status_code == status.HTTP_200_OK
 
     # Verify both used same session
-    assert mock_rag_system.query.call_count == 2
-    calls = mock_rag_system.query.call_args_list
-    assert calls[0][0][1] == session_id
-    assert calls[1][0][1] == session_id
+    assert mock_rag_system.aquery.call_count == 2
+    sessions = [call.args[1] for call in mock_rag_system.aquery.call_args_list]
+    assert sessions == [session_id, session_id]
+
+
+# ============================================================================
+# POST /api/query/batch ENDPOINT TESTS
+# ============================================================================
+
+
+async def test_query_batch_answers_all_queries_together(aclient, mock_rag_system):
+    """Test batched queries reach the RAG system in one call, in request order"""
+    mock_rag_system.session_manager.create_session.return_value = "new_session"
+    mock_rag_system.abatch_query.return_value = [
+        ("Answer 1", []),
+        ("Answer 2", [{"text": "Course 1 - Lesson 1", "link": None}]),
+    ]
+
+    # Execute
+    response = await aclient.post(
+        "/api/query/batch",
+        json={
+            "queries": [
+                {"query": "Question 1", "session_id": "session_1"},
+                {"query": "Question 2"},
+            ]
+        },
+    )
+
+    # Verify
+    assert response.status_code == status.HTTP_200_OK
+    mock_rag_system.abatch_query.assert_awaited_once_with(
+        [("Question 1", "session_1"), ("Question 2", "new_session")]
+    )
+    results = response.json()["results"]
+    assert [r["answer"] for r in results] == ["Answer 1", "Answer 2"]
+    assert [r["session_id"] for r in results] == ["session_1", "new_session"]
+    assert results[1]["sources"][0]["text"] == "Course 1 - Lesson 1"
+
+
+async def test_query_batch_reports_failed_queries(aclient, mock_rag_system):
+    """Test one failed query is reported in its result, not as a 500"""
+    mock_rag_system.abatch_query.return_value = [
+        ("Answer 1", []),
+        TimeoutError("Batch did not end within 300 s"),
+    ]
+
+    response = await aclient.post(
+        "/api/query/batch",
+        json={
+            "queries": [
+                {"query": "Question 1", "session_id": "session_1"},
+                {"query": "Question 2", "session_id": "session_2"},
+            ]
+        },
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    first, second = response.json()["results"]
+    assert first["answer"] == "Answer 1"
+    assert first["error"] is None
+    assert second["answer"] == ""
+    assert second["session_id"] == "session_2"
+    assert second["error"] == "Batch did not end within 300 s"
+
+
+async def test_query_batch_rejects_empty_batch(aclient, mock_rag_system):
+    """Test a batch must hold at least one query"""
+    response = await aclient.post("/api/query/batch", json={"queries": []})
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    mock_rag_system.abatch_query.assert_not_awaited()
+
+
+# ============================================================================
+# POST /api/query/stream ENDPOINT TESTS
+# ============================================================================
+
+
+def parse_sse(body):
+    """Decode the JSON payloads of a server-sent event stream"""
+    return [
+        json.loads(line.removeprefix("data: "))
+        for line in body.split("\n\n")
+        if line.startswith("data: ")
+    ]
+
+
+async def test_query_stream_emits_text_then_done(aclient, mock_rag_system):
+    """Test streamed answers arrive as SSE events ending with the session ID"""
+
+    # Setup
+    async def astream(_query, _session_id):
+        yield {"type": "text", "text": "Prompt "}
+        yield {"type": "text", "text": "engineering"}
+        yield {"type": "sources", "sources": [{"text": "Lesson 1", "link": None}]}
+
+    mock_rag_system.astream.side_effect = astream
+
+    # Execute
+    response = await aclient.post(
+        "/api/query/stream",
+        json={"query": "What is prompt engineering?", "session_id": "stream_1"},
+    )
+
+    # Verify
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert parse_sse(response.text) == [
+        {"type": "text", "text": "Prompt "},
+        {"type": "text", "text": "engineering"},
+        {"type": "sources", "sources": [{"text": "Lesson 1", "link": None}]},
+        {"type": "done", "session_id": "stream_1"},
+    ]
+    mock_rag_system.astream.assert_called_once_with(
+        "What is prompt engineering?", "stream_1"
+    )
+
+
+async def test_query_streams_when_client_accepts_event_stream(aclient, mock_rag_system):
+    """Test /api/query answers with SSE events when the client asks for them"""
+
+    # Setup
+    async def astream(_query, _session_id):
+        yield {"type": "text", "text": "Prompt "}
+        yield {"type": "text", "text": "engineering"}
+
+    mock_rag_system.astream.side_effect = astream
+
+    # Execute
+    async with aclient.stream(
+        "POST",
+        "/api/query",
+        json={"query": "What is prompt engineering?", "session_id": "stream_2"},
+        headers={"Accept": "text/event-stream"},
+    ) as response:
+        body = "".join([chunk async for chunk in response.aiter_text()])
+
+    # Verify
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert parse_sse(body) == [
+        {"type": "text", "text": "Prompt "},
+        {"type": "text", "text": "engineering"},
+        {"type": "done", "session_id": "stream_2"},
+    ]
+    mock_rag_system.aquery.assert_not_called()
+
+
+async def test_query_stream_reports_errors_in_stream(aclient, mock_rag_system):
+    """Test failures after the stream starts are sent as an error event"""
+
+    # Setup
+    message = "API unavailable"
+
+    async def astream(_query, _session_id):
+        yield {"type": "text", "text": "Partial"}
+        raise RuntimeError(message)
+
+    mock_rag_system.astream.side_effect = astream
+    mock_rag_system.session_manager.create_session.return_value = "new_session"
+
+    # Execute
+    response = await aclient.post("/api/query/stream", json={"query": "Test"})
+
+    # Verify
+    assert response.status_code == status.HTTP_200_OK
+    assert parse_sse(response.text) == [
+        {"type": "text", "text": "Partial"},
+        {"type": "error", "detail": "API unavailable"},
+        {"type": "done", "session_id": "new_session"},
+    ]
 
 
 # ============================================================================
@@ -157,11 +324,10 @@ def test_query_endpoint_preserves_conversation_context(client, mock_rag_system):
 # ============================================================================
 
 
-@pytest.mark.api
-def test_get_courses_success(client, mock_rag_system):
+async def test_get_courses_success(aclient, mock_rag_system):
     """Test successful retrieval of course statistics"""
     # Execute
-    response = client.get("/api/courses")
+    response = await aclient.get("/api/courses")
 
     # Verify response
     assert response.status_code == status.HTTP_200_OK
@@ -185,8 +351,7 @@ def test_get_courses_success(client, mock_rag_system):
     mock_rag_system.get_course_analytics.assert_called_once()
 
 
-@pytest.mark.api
-def test_get_courses_empty_catalog(client, mock_rag_system):
+async def test_get_courses_empty_catalog(aclient, mock_rag_system):
     """Test response when no courses are loaded"""
     # Configure mock for empty state
     mock_rag_system.get_course_analytics.return_value = {
@@ -194,7 +359,7 @@ def test_get_courses_empty_catalog(client, mock_rag_system):
         "courses": [],
     }
 
-    response = client.get("/api/courses")
+    response = await aclient.get("/api/courses")
 
     assert response.status_code == status.HTTP_200_OK
     data = response.json()
@@ -202,26 +367,21 @@ def test_get_courses_empty_catalog(client, mock_rag_system):
     assert data["courses"] == []
 
 
-@pytest.mark.api
-def test_get_courses_handles_exception(client):
+async def test_get_courses_handles_exception(aclient, failing_rag):
     """Test error handling when analytics fails"""
-    with patch("app.rag_system") as mock_rag:
-        mock_rag.get_course_analytics.side_effect = Exception(
-            "ChromaDB not initialized"
-        )
+    failing_rag.get_course_analytics.side_effect = Exception("ChromaDB not initialized")
 
-        response = client.get("/api/courses")
+    response = await aclient.get("/api/courses")
 
-        assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
-        data = response.json()
-        assert "detail" in data
+    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+    data = response.json()
+    assert "detail" in data
 
 
-@pytest.mark.api
 @pytest.mark.usefixtures("mock_rag_system")
-def test_get_courses_response_schema(client):
+async def test_get_courses_response_schema(aclient):
     """Test that response matches CourseStats schema exactly"""
-    response = client.get("/api/courses")
+    response = await aclient.get("/api/courses")
 
     assert response.status_code == status.HTTP_200_OK
     data = response.json()
@@ -241,18 +401,86 @@ def test_get_courses_response_schema(client):
         )
 
 
+async def test_get_courses_cached_with_etag(aclient, mock_rag_system):
+    """Test repeat polls reuse the catalog and revalidate with its ETag"""
+    # Execute
+    first = await aclient.get("/api/courses")
+    second = await aclient.get("/api/courses")
+    revalidated = await aclient.get(
+        "/api/courses", headers={"If-None-Match": first.headers["ETag"]}
+    )
+
+    # Verify analytics computed once and the unchanged catalog not resent
+    mock_rag_system.get_course_analytics.assert_called_once()
+    assert second.json() == first.json()
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert revalidated.status_code == status.HTTP_304_NOT_MODIFIED
+    assert revalidated.content == b""
+
+
+async def test_get_courses_recomputed_when_catalog_changes(aclient, mock_rag_system):
+    """Test ingesting courses invalidates the cached catalog"""
+    first = await aclient.get("/api/courses")
+
+    # Simulate ingestion adding a course
+    mock_rag_system.vector_store.catalog_version += 1
+    mock_rag_system.get_course_analytics.return_value = {
+        "total_courses": 1,
+        "courses": [{"title": "New Course", "first_lesson_link": None}],
+    }
+    response = await aclient.get(
+        "/api/courses", headers={"If-None-Match": first.headers["ETag"]}
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["total_courses"] == 1
+    assert response.headers["ETag"] != first.headers["ETag"]
+
+
 # ============================================================================
-# DELETE /api/session/{session_id} ENDPOINT TESTS
+# GET /api/health ENDPOINT TESTS
 # ============================================================================
 
 
-@pytest.mark.api
-def test_clear_session_success(client, mock_rag_system):
-    """Test successful session clearing"""
-    session_id = "session_to_clear"
+async def test_health_reports_ingestion_status(aclient, mock_rag_system):
+    """Test health check exposes background ingestion progress"""
+    mock_rag_system.ingestion_status = {
+        "state": "running",
+        "courses": 1,
+        "chunks": 10,
+        "error": None,
+    }
+
+    # Execute
+    response = await aclient.get("/api/health")
 
+    # Verify
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        "status": "ok",
+        "ingestion": {"state": "running", "courses": 1, "chunks": 10, "error": None},
+    }
+
+
+# ============================================================================
+# DELETE /api/session/{session_id} ENDPOINT TESTS
+# ============================================================================
+
+
+@pytest.mark.parametrize(
+    "session_id",
+    [
+        pytest.param("session_to_clear", id="existing"),
+        # SessionManager.clear_session handles non-existent sessions gracefully
+        pytest.param("nonexistent_session", id="nonexistent"),
+        # Session IDs might contain underscores, hyphens, etc.
+        pytest.param("session-123_test", id="special_characters"),
+    ],
+)
+async def test_clear_session(aclient, mock_rag_system, session_id):
+    """Test session clearing returns 200 OK and clears the given session"""
     # Execute
-    response = client.delete(f"/api/session/{session_id}")
+    response = await aclient.delete(f"/api/session/{session_id}")
 
     # Verify response
     assert response.status_code == status.HTTP_200_OK
@@ -265,40 +493,29 @@ def test_clear_session_success(client, mock_rag_system):
     mock_rag_system.session_manager.clear_session.assert_called_once_with(session_id)
 
 
-@pytest.mark.api
-@pytest.mark.usefixtures("mock_rag_system")
-def test_clear_nonexistent_session(client):
-    """Test clearing session that doesn't exist (should succeed silently)"""
-    # SessionManager.clear_session handles non-existent sessions gracefully
-    response = client.delete("/api/session/nonexistent_session")
-
-    # Should still return 200 OK
-    assert response.status_code == status.HTTP_200_OK
-
-
-@pytest.mark.api
-def test_clear_session_handles_exception(client):
+async def test_clear_session_handles_exception(aclient, failing_rag):
     """Test error handling in session clearing"""
-    with patch("app.rag_system") as mock_rag:
-        mock_rag.session_manager.clear_session.side_effect = Exception(
-            "Session DB error"
-        )
+    failing_rag.session_manager.clear_session.side_effect = Exception(
+        "Session DB error"
+    )
+
+    response = await aclient.delete("/api/session/test_session")
 
-        response = client.delete("/api/session/test_session")
+    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
 
-        assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
 
+# ============================================================================
+# POST /api/cache/clear ENDPOINT TESTS
+# ============================================================================
 
-@pytest.mark.api
-def test_clear_session_with_special_characters(client, mock_rag_system):
-    """Test session IDs with special characters (URL encoding)"""
-    # Session IDs might contain underscores, hyphens, etc.
-    session_id = "session-123_test"
 
-    response = client.delete(f"/api/session/{session_id}")
+async def test_clear_cache_success(aclient, mock_rag_system):
+    """Test clearing the semantic cache"""
+    response = await aclient.post("/api/cache/clear")
 
     assert response.status_code == status.HTTP_200_OK
-    mock_rag_system.session_manager.clear_session.assert_called_once_with(session_id)
+    assert response.json()["status"] == "ok"
+    mock_rag_system.clear_cache.assert_called_once_with()
 
 
 # ============================================================================
@@ -306,17 +523,16 @@ def test_clear_session_with_special_characters(client, mock_rag_system):
 # ============================================================================
 
 
-@pytest.mark.api
 @pytest.mark.integration
 @pytest.mark.usefixtures("mock_rag_system")
-def test_full_conversation_flow(client):
+async def test_full_conversation_flow(aclient):
     """Test complete flow: query → get courses → clear session"""
     # 1. Get available courses
-    courses_response = client.get("/api/courses")
+    courses_response = await aclient.get("/api/courses")
     assert courses_response.status_code == status.HTTP_200_OK
 
     # 2. Make a query
-    query_response = client.post(
+    query_response = await aclient.post(
         "/api/query",
         json={"query": "Tell me about the first course", "session_id": "flow_session"},
     )
@@ -324,26 +540,31 @@ def test_full_conversation_flow(client):
     session_id = query_response.json()["session_id"]
 
     # 3. Clear the session
-    clear_response = client.delete(f"/api/session/{session_id}")
+    clear_response = await aclient.delete(f"/api/session/{session_id}")
     assert clear_response.status_code == status.HTTP_200_OK
 
 
-@pytest.mark.api
 @pytest.mark.integration
-def test_concurrent_sessions(client, mock_rag_system):
+async def test_concurrent_sessions(aclient, mock_rag_system):
     """Test that multiple concurrent sessions are handled correctly"""
     sessions = ["session_a", "session_b", "session_c"]
 
-    for session_id in sessions:
-        response = client.post(
-            "/api/query",
-            json={"query": f"Query for {session_id}", "session_id": session_id},
+    responses = await asyncio.gather(
+        *(
+            aclient.post(
+                "/api/query",
+                json={"query": f"Query for {session_id}", "session_id": session_id},
+            )
+            for session_id in sessions
         )
+    )
+
+    for session_id, response in zip(sessions, responses, strict=True):
         assert response.status_code == status.HTTP_200_OK
         assert response.json()["session_id"] == session_id
 
     # Each session should have been used once
-    assert mock_rag_system.query.call_count == len(sessions)
+    assert mock_rag_system.aquery.call_count == len(sessions)
 
 
 # ============================================================================
@@ -351,27 +572,24 @@ def test_concurrent_sessions(client, mock_rag_system):
 # ============================================================================
 
 
-@pytest.mark.api
-def test_error_response_format_500(client):
+async def test_error_response_format_500(aclient, failing_rag):
     """Test that 500 errors follow FastAPI HTTPException format"""
-    with patch("app.rag_system") as mock_rag:
-        mock_rag.query.side_effect = Exception("Test error")
-        mock_rag.session_manager.create_session.return_value = "session"
+    failing_rag.aquery.side_effect = Exception("Test error")
+    failing_rag.session_manager.create_session.return_value = "session"
 
-        response = client.post("/api/query", json={"query": "test"})
+    response = await aclient.post("/api/query", json={"query": "test"})
 
-        assert response.status_code == 500
-        data = response.json()
+    assert response.status_code == 500
+    data = response.json()
 
-        # FastAPI error format
-        assert "detail" in data
-        assert isinstance(data["detail"], str)
+    # FastAPI error format
+    assert "detail" in data
+    assert isinstance(data["detail"], str)
 
 
-@pytest.mark.api
-def test_error_response_format_422(client):
+async def test_error_response_format_422(aclient):
     """Test that validation errors follow FastAPI format"""
-    response = client.post("/api/query", json={"invalid_field": "value"})
+    response = await aclient.post("/api/query", json={"invalid_field": "value"})
 
     assert response.status_code == 422
     data = response.json()
@@ -387,13 +605,14 @@ def test_error_response_format_422(client):
 # ============================================================================
 
 
-@pytest.mark.api
-def test_cors_headers_present(client):
+async def test_cors_headers_present(aclient):
     """Test that CORS headers are present in responses"""
-    response = client.get("/api/courses", headers={"Origin": "http://localhost:3000"})
+    response = await aclient.get(
+        "/api/courses", headers={"Origin": "http://localhost:3000"}
+    )
 
     # CORS middleware should add headers
-    # TestClient might not include all headers, but endpoint should work
+    # The in-process client might not include all headers, but endpoint should work
     assert response.status_code == status.HTTP_200_OK
 
 
@@ -402,11 +621,10 @@ def test_cors_headers_present(client):
 # ============================================================================
 
 
-@pytest.mark.api
 @pytest.mark.usefixtures("mock_rag_system")
-def test_query_response_schema(client):
+async def test_query_response_schema(aclient):
     """Test that QueryResponse matches expected schema"""
-    response = client.post(
+    response = await aclient.post(
         "/api/query", json={"query": "Test query", "session_id": "test_session"}
     )
 
@@ -427,3 +645,67 @@ def test_query_response_schema(client):
     for source in data["sources"]:
         assert "text" in source
         assert "link" in source
+
+
+# ============================================================================
+# APP LIFESPAN TESTS
+# ============================================================================
+
+
+def test_lifespan_creates_rag_system_with_shared_client(mock_rag_system):
+    """Test startup builds the RAG system on the pooled client and closes it"""
+    with patch("app.RAGSystem", return_value=mock_rag_system) as rag_cls:
+        app = create_app(mount_static=False, skip_startup=True)
+
+        with TestClient(app) as test_client:
+            http_client = app.state.http_client
+            response = test_client.get("/api/health")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert app.state.rag_system is mock_rag_system
+    assert rag_cls.call_args.kwargs["http_client"] is http_client
+    assert http_client.is_closed
+
+
+@pytest.fixture
+def docs_dir(tmp_path, monkeypatch):
+    """Run from a backend directory whose ../docs folder exists"""
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "backend").mkdir()
+    monkeypatch.chdir(tmp_path / "backend")
+
+
+@pytest.mark.usefixtures("docs_dir")
+def test_lifespan_waits_for_background_ingestion(mock_rag_system):
+    """Test startup ingests ../docs in a thread and shutdown waits for it"""
+    mock_rag_system.async_ai_generator = AsyncMock()
+
+    def ingest_folder(_folder_path):
+        time.sleep(0.05)  # Still running when shutdown begins
+
+    mock_rag_system.ingest_folder.side_effect = ingest_folder
+    app = create_app(mount_static=False, rag_system=mock_rag_system)
+
+    with TestClient(app) as test_client:
+        response = test_client.get("/api/health")
+
+    # Verify health answered during ingestion and shutdown let it finish
+    assert response.status_code == status.HTTP_200_OK
+    mock_rag_system.async_ai_generator.warm_up.assert_awaited_once()
+    mock_rag_system.ingest_folder.assert_called_once_with("../docs")
+    assert app.state.ingestion_task.done()
+    assert not app.state.ingestion_task.cancelled()
+
+
+@pytest.mark.usefixtures("docs_dir")
+def test_lifespan_reports_failed_background_ingestion(mock_rag_system, caplog):
+    """Test an ingestion task's exception is retrieved and logged at shutdown"""
+    mock_rag_system.async_ai_generator = AsyncMock()
+    mock_rag_system.ingest_folder.side_effect = RuntimeError("Disk full")
+    app = create_app(mount_static=False, rag_system=mock_rag_system)
+
+    with caplog.at_level(logging.ERROR, logger="app"), TestClient(app):
+        pass
+
+    assert "Background document ingestion failed" in caplog.text
+    assert "Disk full" in caplog.text
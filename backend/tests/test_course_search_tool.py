@@ -1,20 +1,33 @@
 """
 Tests for CourseSearchTool.execute() method
 Tests cover: basic search, filters, error handling, formatting, and source tracking
+Also covers CourseOutlineTool lookup caching and BatchTool dispatch
 """
 
-from search_tools import CourseSearchTool
+import threading
+
+import pytest
+from search_tools import (
+    BatchTool,
+    CourseOutlineTool,
+    SearchContext,
+    ToolManager,
+    ToolResult,
+)
 from vector_store import SearchResults
 
 
-def test_execute_basic_query(mock_vector_store, sample_search_results):
+def test_execute_basic_query(
+    make_search_tool, mock_vector_store, sample_search_results
+):
     """Test basic search execution with no filters"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = sample_search_results
+    tool = make_search_tool(sample_search_results)
+
+    context = SearchContext()
 
     # Execute
-    result = tool.execute(query="What is prompt engineering?")
+    result = tool.execute(query="What is prompt engineering?", context=context)
 
     # Verify VectorStore.search called correctly
     mock_vector_store.search.assert_called_once_with(
@@ -22,197 +35,183 @@ def test_execute_basic_query(mock_vector_store, sample_search_results):
     )
 
     # Verify result format
-    assert "[Introduction to Prompt Engineering - Lesson 1]" in result
-    assert "Prompt engineering is the art" in result
+    assert "[Introduction to Prompt Engineering - Lesson 1]" in result.content
+    assert "Prompt engineering is the art" in result.content
 
     # Verify sources tracked
-    assert len(tool.last_sources) == 2
-    assert (
-        tool.last_sources[0]["text"] == "Introduction to Prompt Engineering - Lesson 1"
-    )
-
-
-def test_execute_with_course_name_filter(mock_vector_store, sample_search_results):
-    """Test query with course_name parameter"""
+    assert len(context.sources) == 2
+    assert context.sources[0]["text"] == "Introduction to Prompt Engineering - Lesson 1"
+
+
+@pytest.mark.parametrize(
+    ("course_name", "lesson_number", "expected"),
+    [
+        pytest.param(
+            "Introduction to Prompt Engineering",
+            None,
+            "Prompt engineering",
+            id="course",
+        ),
+        pytest.param(None, 1, "Lesson 1", id="lesson"),
+        pytest.param(
+            "Introduction to Prompt Engineering",
+            1,
+            "Introduction to Prompt Engineering",
+            id="combined",
+        ),
+    ],
+)
+def test_execute_with_filters(
+    make_search_tool,
+    mock_vector_store,
+    sample_search_results,
+    course_name,
+    lesson_number,
+    expected,
+):
+    """Test course_name and lesson_number filters are passed to the search"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = sample_search_results
+    tool = make_search_tool(sample_search_results)
 
     # Execute
     result = tool.execute(
         query="What is prompt engineering?",
-        course_name="Introduction to Prompt Engineering",
+        course_name=course_name,
+        lesson_number=lesson_number,
     )
 
-    # Verify course_name passed to search
+    # Verify filters applied
     mock_vector_store.search.assert_called_once_with(
         query="What is prompt engineering?",
-        course_name="Introduction to Prompt Engineering",
-        lesson_number=None,
-    )
-
-    # Verify results returned
-    assert "Prompt engineering" in result
-
-
-def test_execute_with_lesson_number_filter(mock_vector_store, sample_search_results):
-    """Test query with lesson_number parameter"""
-    # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = sample_search_results
-
-    # Execute
-    result = tool.execute(query="What is prompt engineering?", lesson_number=1)
-
-    # Verify lesson_number passed to search
-    mock_vector_store.search.assert_called_once_with(
-        query="What is prompt engineering?", course_name=None, lesson_number=1
+        course_name=course_name,
+        lesson_number=lesson_number,
     )
 
     # Verify results returned
-    assert "Lesson 1" in result
-
+    assert expected in result.content
 
-def test_execute_with_combined_filters(mock_vector_store, sample_search_results):
-    """Test query with both course_name and lesson_number"""
-    # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = sample_search_results
 
-    # Execute
-    result = tool.execute(
-        query="What is prompt engineering?",
-        course_name="Introduction to Prompt Engineering",
-        lesson_number=1,
-    )
-
-    # Verify both filters applied
-    mock_vector_store.search.assert_called_once_with(
-        query="What is prompt engineering?",
-        course_name="Introduction to Prompt Engineering",
-        lesson_number=1,
-    )
-
-    # Verify results returned
-    assert "Introduction to Prompt Engineering" in result
-
-
-def test_execute_empty_results(mock_vector_store, empty_search_results):
+def test_execute_empty_results(make_search_tool, empty_search_results):
     """Test handling of no matches found"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = empty_search_results
+    tool = make_search_tool(empty_search_results)
+
+    context = SearchContext()
 
     # Execute
-    result = tool.execute(query="nonexistent topic")
+    result = tool.execute(query="nonexistent topic", context=context)
 
-    # Verify message
-    assert "No relevant content found" in result
+    # Verify message, which is an answer rather than a tool failure
+    assert "No relevant content found" in result.content
+    assert not result.is_error
 
-    # Verify last_sources updated (should be empty list based on _format_results)
-    # Note: execute() doesn't explicitly clear sources on empty, but _format_results won't populate them
-    assert len(tool.last_sources) == 0
+    # Verify no sources recorded
+    assert len(context.sources) == 0
 
 
-def test_execute_empty_results_with_filters(mock_vector_store, empty_search_results):
+def test_execute_empty_results_with_filters(make_search_tool, empty_search_results):
     """Test empty results message includes filter context"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = empty_search_results
+    tool = make_search_tool(empty_search_results)
 
     # Execute with course filter
     result1 = tool.execute(query="nonexistent", course_name="Some Course")
-    assert "No relevant content found in course 'Some Course'" in result1
+    assert "No relevant content found in course 'Some Course'" in result1.content
 
     # Execute with lesson filter
     result2 = tool.execute(query="nonexistent", lesson_number=5)
-    assert "No relevant content found in lesson 5" in result2
+    assert "No relevant content found in lesson 5" in result2.content
 
     # Execute with both filters
     result3 = tool.execute(
         query="nonexistent", course_name="Some Course", lesson_number=5
     )
-    assert "No relevant content found in course 'Some Course' in lesson 5" in result3
+    assert (
+        "No relevant content found in course 'Some Course' in lesson 5"
+        in result3.content
+    )
 
 
-def test_execute_error_from_vector_store(mock_vector_store, error_search_results):
+def test_execute_error_from_vector_store(make_search_tool, error_search_results):
     """Test error propagation from VectorStore"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = error_search_results
+    tool = make_search_tool(error_search_results)
 
     # Execute
     result = tool.execute(query="any query")
 
-    # Verify error message propagated
-    assert "Database connection failed" in result
+    # Verify error message propagated and flagged
+    assert "Database connection failed" in result.content
+    assert result.is_error
 
 
-def test_format_results_with_lessons(mock_vector_store, sample_search_results):
+def test_format_results_with_lessons(make_search_tool, sample_search_results):
     """Test formatting with lesson metadata"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = sample_search_results
+    tool = make_search_tool(sample_search_results)
 
     # Execute
     result = tool.execute(query="test")
 
     # Verify header format
-    assert "[Introduction to Prompt Engineering - Lesson 1]" in result
-    assert "[Introduction to Prompt Engineering - Lesson 2]" in result
+    assert "[Introduction to Prompt Engineering - Lesson 1]" in result.content
+    assert "[Introduction to Prompt Engineering - Lesson 2]" in result.content
 
     # Verify content follows header
-    lines = result.split("\n")
+    lines = result.content.split("\n")
     # Find the header line and verify content is on next line
     for i, line in enumerate(lines):
         if "[Introduction to Prompt Engineering - Lesson 1]" in line:
             assert "Prompt engineering is the art" in lines[i + 1]
 
 
-def test_format_results_with_links(mock_vector_store, sample_search_results):
+def test_format_results_with_links(
+    make_search_tool, mock_vector_store, sample_search_results
+):
     """Test results with lesson links"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = sample_search_results
-    mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson1"
+    tool = make_search_tool(sample_search_results)
 
-    # Execute
-    tool.execute(query="test")
+    context = SearchContext()
 
-    # Verify get_lesson_link called for lessons
-    assert mock_vector_store.get_lesson_link.called
+    # Execute
+    tool.execute(query="test", context=context)
+
+    # Verify lesson links fetched in one batched lookup
+    mock_vector_store.get_lesson_links.assert_called_once_with(
+        [
+            ("Introduction to Prompt Engineering", 1),
+            ("Introduction to Prompt Engineering", 2),
+        ]
+    )
 
     # Verify sources contain links
-    assert len(tool.last_sources) == 2
-    assert tool.last_sources[0]["link"] == "https://example.com/lesson1"
+    assert len(context.sources) == 2
+    assert context.sources[0]["link"] == "https://example.com/lesson1"
 
 
-def test_last_sources_tracking(mock_vector_store, sample_search_results):
-    """Test source tracking mechanism"""
+def test_sources_tracking(make_search_tool, sample_search_results):
+    """Test sources are recorded in the request context"""
     # Setup
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = sample_search_results
+    tool = make_search_tool(sample_search_results)
+    context = SearchContext()
 
     # Execute
-    tool.execute(query="test")
+    tool.execute(query="test", context=context)
 
-    # Verify last_sources updated
-    assert len(tool.last_sources) == 2
+    # Verify sources recorded
+    assert len(context.sources) == 2
 
     # Verify source structure
-    assert "text" in tool.last_sources[0]
-    assert "link" in tool.last_sources[0]
+    assert "text" in context.sources[0]
+    assert "link" in context.sources[0]
 
     # Verify source content
-    assert (
-        tool.last_sources[0]["text"] == "Introduction to Prompt Engineering - Lesson 1"
-    )
-    assert (
-        tool.last_sources[1]["text"] == "Introduction to Prompt Engineering - Lesson 2"
-    )
+    assert context.sources[0]["text"] == "Introduction to Prompt Engineering - Lesson 1"
+    assert context.sources[1]["text"] == "Introduction to Prompt Engineering - Lesson 2"
 
 
-def test_multiple_documents_formatting(mock_vector_store):
+def test_multiple_documents_formatting(make_search_tool):
     """Test multiple search results formatting"""
     # Setup - create multi-doc results
     multi_results = SearchResults(
@@ -230,27 +229,20 @@ def test_multiple_documents_formatting(mock_vector_store):
         error=None,
     )
 
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = multi_results
+    tool = make_search_tool(multi_results)
 
     # Execute
     result = tool.execute(query="test")
 
-    # Verify documents separated by "\n\n"
-    assert "\n\n" in result
-
-    # Verify all documents have headers
-    assert "[Course A - Lesson 1]" in result
-    assert "[Course B - Lesson 2]" in result
-    assert "[Course C - Lesson 3]" in result
-
-    # Verify all content included
-    assert "First document content" in result
-    assert "Second document content" in result
-    assert "Third document content" in result
+    # Verify each document under its header, separated by "\n\n"
+    assert result.content == (
+        "[Course A - Lesson 1]\nFirst document content.\n\n"
+        "[Course B - Lesson 2]\nSecond document content.\n\n"
+        "[Course C - Lesson 3]\nThird document content."
+    )
 
 
-def test_metadata_missing_fields(mock_vector_store):
+def test_metadata_missing_fields(make_search_tool):
     """Test handling of incomplete metadata"""
     # Setup - results with missing metadata
     incomplete_results = SearchResults(
@@ -262,17 +254,144 @@ def test_metadata_missing_fields(mock_vector_store):
         error=None,
     )
 
-    tool = CourseSearchTool(mock_vector_store)
-    mock_vector_store.search.return_value = incomplete_results
+    tool = make_search_tool(incomplete_results)
 
     # Execute
     result = tool.execute(query="test")
 
     # Verify defaults to 'unknown' for missing course_title
-    assert "[unknown]" in result
+    assert "[unknown]" in result.content
 
     # Verify content still included
-    assert "Some content" in result
+    assert "Some content" in result.content
 
     # Verify no crash
     assert result is not None
+
+
+def test_outline_lookups_cached_between_calls(mock_vector_store):
+    """Test repeated outline requests skip the catalog query and JSON parse"""
+    mock_vector_store.catalog_version = 1
+    mock_vector_store.course_catalog.query.return_value = {
+        "documents": [["MCP"]],
+        "metadatas": [[{"title": "MCP Course"}]],
+    }
+    mock_vector_store.course_catalog.get.return_value = {
+        "metadatas": [{"title": "MCP Course", "lessons_json": "[]"}]
+    }
+
+    tool = CourseOutlineTool(mock_vector_store)
+
+    # Execute twice
+    first = tool.execute(course_name="MCP")
+    second = tool.execute(course_name="MCP")
+
+    # Verify identical output from a single round-trip per lookup
+    assert first == second
+    assert mock_vector_store.course_catalog.query.call_count == 1
+    assert mock_vector_store.course_catalog.get.call_count == 1
+
+
+def test_outline_cache_invalidated_on_catalog_change(mock_vector_store):
+    """Test a catalog version bump forces fresh lookups"""
+    mock_vector_store.catalog_version = 1
+    mock_vector_store.course_catalog.query.return_value = {
+        "documents": [["MCP"]],
+        "metadatas": [[{"title": "MCP Course"}]],
+    }
+    mock_vector_store.course_catalog.get.return_value = {
+        "metadatas": [{"title": "MCP Course", "lessons_json": "[]"}]
+    }
+
+    tool = CourseOutlineTool(mock_vector_store)
+    tool.execute(course_name="MCP")
+
+    # Simulate add_course_metadata, then execute again
+    mock_vector_store.catalog_version = 2
+    tool.execute(course_name="MCP")
+
+    # Verify
+    assert mock_vector_store.course_catalog.query.call_count == 2
+    assert mock_vector_store.course_catalog.get.call_count == 2
+
+
+def test_batch_tool_runs_invocations_concurrently(mock_tool_manager):
+    """Test batched calls dispatch at once and return in invocation order"""
+    # Each call waits for the other, so sequential execution would time out
+    barrier = threading.Barrier(2, timeout=5)
+    results = {"search_course_content": "Result 1", "get_course_outline": "Outline"}
+
+    def execute_tool(name, **_kwargs):
+        barrier.wait()
+        return ToolResult(results[name])
+
+    mock_tool_manager.execute_tool.side_effect = execute_tool
+    context = SearchContext()
+
+    # Execute
+    result = BatchTool(mock_tool_manager).execute(
+        invocations=[
+            {"name": "search_course_content", "arguments": {"query": "MCP"}},
+            {"name": "get_course_outline", "arguments": '{"course_name": "MCP"}'},
+        ],
+        context=context,
+    )
+
+    # Verify
+    assert not result.is_error
+    assert not context.failed
+    assert result.content == (
+        "[search_course_content]\nResult 1\n\n[get_course_outline]\nOutline"
+    )
+    mock_tool_manager.execute_tool.assert_any_call(
+        "search_course_content", context=context, query="MCP"
+    )
+    mock_tool_manager.execute_tool.assert_any_call(
+        "get_course_outline", context=context, course_name="MCP"
+    )
+
+
+def test_batch_tool_reports_failed_invocations(mock_tool_manager):
+    """Test failing or nested calls are flagged without hiding the others"""
+    mock_tool_manager.execute_tool.side_effect = [
+        ToolResult("Result 1"),
+        RuntimeError("Database connection failed"),
+    ]
+    context = SearchContext()
+
+    # Execute
+    result = BatchTool(mock_tool_manager).execute(
+        invocations=[
+            {"name": "search_course_content", "arguments": {"query": "MCP"}},
+            {"name": "search_course_content", "arguments": {"query": "RAG"}},
+            {"name": "batch_tool", "arguments": {"invocations": []}},
+        ],
+        context=context,
+    )
+
+    # Verify only a batch where every call failed is an error, but any
+    # failed call keeps the answer out of the caches
+    assert not result.is_error
+    assert context.failed
+    assert "[search_course_content]\nResult 1" in result.content
+    assert "Tool execution failed: Database connection failed" in result.content
+    assert "[batch_tool (error)]\nbatch_tool cannot be nested" in result.content
+    assert mock_tool_manager.execute_tool.call_count == 2
+
+
+def test_tool_manager_skips_tools_for_cancelled_request(make_search_tool):
+    """Test a cancelled request's tools are not run"""
+    tool = make_search_tool(None)
+    tool_manager = ToolManager()
+    tool_manager.register_tool(tool)
+
+    # Execute
+    result = tool_manager.execute_tool(
+        "search_course_content",
+        context=SearchContext(cancelled=True),
+        query="MCP",
+    )
+
+    # Verify
+    assert result.is_error
+    tool.store.search.assert_not_called()
@@ -3,28 +3,22 @@ Tests for RAG System integration
 Tests cover: end-to-end query processing, session management, and tool orchestration
 """
 
-from unittest.mock import MagicMock
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
 
+import pytest
 from models import Course, Lesson
 from rag_system import RAGSystem
 from vector_store import SearchResults
 
 
-def test_query_general_knowledge(mocker, test_config):
+@pytest.mark.usefixtures("rag_patches")
+def test_query_general_knowledge(test_config, anthropic_mock, make_text_response):
     """Test non-course question without tool use"""
     # Setup mock response without tools
-    mock_response = MagicMock()
-    mock_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Python is a programming language."
-    mock_response.content = [text_block]
+    mock_response = make_text_response("Python is a programming language.")
 
-    mock_client = MagicMock()
-    mock_client.messages.create.return_value = mock_response
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
+    anthropic_mock.messages.create.return_value = mock_response
 
     # Execute
     rag = RAGSystem(test_config)
@@ -36,103 +30,151 @@ def test_query_general_knowledge(mocker, test_config):
     assert isinstance(sources, list)
 
 
-def test_query_course_specific(mocker, test_config):
-    """Test course content question with tool use"""
-    # Setup tool use response
-    tool_use_response = MagicMock()
-    tool_use_response.stop_reason = "tool_use"
-    tool_block = MagicMock()
-    tool_block.type = "tool_use"
-    tool_block.name = "search_course_content"
-    tool_block.id = "tool_123"
-    tool_block.input = {"query": "prompt engineering"}
-    tool_use_response.content = [tool_block]
-
-    # Setup final response
-    text_response = MagicMock()
-    text_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Based on the course materials, prompt engineering is..."
-    text_response.content = [text_block]
-
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = [tool_use_response, text_response]
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-
-    # Mock VectorStore
-    mock_vector_store = MagicMock()
-    search_results = SearchResults(
-        documents=["Prompt engineering content"],
-        metadata=[{"course_title": "Test Course", "lesson_number": 1}],
-        distances=[0.1],
-        error=None,
-    )
-    mock_vector_store.search.return_value = search_results
-    mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson1"
-
-    mocker.patch("rag_system.VectorStore", return_value=mock_vector_store)
-    mocker.patch("rag_system.DocumentProcessor")
+# Single search round: Claude searches once, then answers from the results
+SAMPLE_SOURCES = [
+    {
+        "text": "Introduction to Prompt Engineering - Lesson 1",
+        "link": "https://example.com/lesson1",
+    },
+    {
+        "text": "Introduction to Prompt Engineering - Lesson 2",
+        "link": "https://example.com/lesson1",
+    },
+]
+
+
+@pytest.mark.parametrize(
+    ("results", "tool_content", "is_error", "expected_sources"),
+    [
+        pytest.param(
+            "sample_search_results",
+            "[Introduction to Prompt Engineering - Lesson 1]\nLesson 1 content",
+            False,
+            SAMPLE_SOURCES,
+            id="results",
+        ),
+        pytest.param(
+            "empty_search_results", "No relevant content found.", False, [], id="empty"
+        ),
+        pytest.param(
+            "error_search_results", "Database connection failed", True, [], id="error"
+        ),
+    ],
+)
+def test_query_with_search_round(
+    results,
+    tool_content,
+    is_error,
+    expected_sources,
+    request,
+    rag_patches,
+    mock_vector_store,
+    test_config,
+    anthropic_mock,
+    make_tool_use_response,
+    make_text_response,
+):
+    """Test search output reaches Claude and its sources come back with the answer"""
+    # Setup
+    anthropic_mock.messages.create.side_effect = [
+        make_tool_use_response(tool_input={"query": "prompt engineering"}),
+        make_text_response("Final answer"),
+    ]
+    mock_vector_store.search.return_value = request.getfixturevalue(results)
+    rag_patches.vector_store.return_value = mock_vector_store
 
     # Execute
     rag = RAGSystem(test_config)
     response, sources = rag.query("What is prompt engineering?")
 
-    # Verify search executed
-    assert mock_vector_store.search.called
-
-    # Verify response
-    assert "Based on the course materials" in response
-
-    # Verify sources returned
-    assert len(sources) > 0
-
-
-def test_query_with_session(mocker, test_config):
-    """Test query with session_id includes history"""
-    # Setup response
-    mock_response = MagicMock()
-    mock_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Answer based on context"
-    mock_response.content = [text_block]
-
-    mock_client = MagicMock()
-    mock_client.messages.create.return_value = mock_response
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
-
-    # Execute
+    # Verify the search result was sent back to Claude
+    mock_vector_store.search.assert_called_once_with(
+        query="prompt engineering", course_name=None, lesson_number=None
+    )
+    second_call = anthropic_mock.messages.create.call_args_list[1]
+    tool_result = second_call.kwargs["messages"][2]["content"][0]
+    assert tool_result["content"].startswith(tool_content)
+    assert tool_result["is_error"] is is_error
+
+    # Verify answer and sources
+    assert response == "Final answer"
+    assert sources == expected_sources
+
+
+# Session history: (session_id, question) queries and the questions each
+# session should remember, every question answered with "Answer to <question>"
+HISTORY_SCENARIOS = [
+    pytest.param(
+        [("test_session", "What is the answer?")],
+        {"test_session": ["What is the answer?"]},
+        id="saved",
+    ),
+    pytest.param(
+        [("test_session", "First question"), ("test_session", "Second question")],
+        {"test_session": ["First question", "Second question"]},
+        id="accumulates",
+    ),
+    pytest.param(
+        [("test_session", f"Question {i}") for i in range(5)],
+        {"test_session": ["Question 3", "Question 4"]},  # MAX_HISTORY = 2
+        id="max_history",
+    ),
+    pytest.param(
+        [
+            ("session_1", "Question for session 1"),
+            ("session_2", "Question for session 2"),
+        ],
+        {
+            "session_1": ["Question for session 1"],
+            "session_2": ["Question for session 2"],
+        },
+        id="isolated",
+    ),
+]
+
+
+@pytest.mark.parametrize(("queries", "expected"), HISTORY_SCENARIOS)
+@pytest.mark.usefixtures("rag_patches")
+def test_session_history(
+    queries, expected, test_config, anthropic_mock, make_text_response
+):
+    """Test exchanges are kept per session, trimmed, and sent with later queries"""
+    # Setup
+    anthropic_mock.messages.create.side_effect = [
+        make_text_response(f"Answer to {question}") for _, question in queries
+    ]
     rag = RAGSystem(test_config)
 
-    # First query to establish history
-    rag.query("First question", session_id="test_session")
-
-    # Second query should include history
-    response, _ = rag.query("Follow-up question", session_id="test_session")
-
-    # Verify history retrieved
-    history = rag.session_manager.get_conversation_history("test_session")
-    assert history is not None
-
-
-def test_query_no_session(mocker, test_config):
+    # Execute
+    for session_id, question in queries:
+        rag.query(question, session_id=session_id)
+
+    # Verify each session holds only its own most recent exchanges
+    for session_id, questions in expected.items():
+        assert rag.session_manager.get_conversation_history(session_id) == "\n".join(
+            f"User: {question}\nAssistant: Answer to {question}"
+            for question in questions
+        )
+
+    # Verify each call carried its session's previous exchange and nothing else
+    previous = {}
+    calls = anthropic_mock.messages.create.call_args_list
+    for (session_id, question), call in zip(queries, calls, strict=True):
+        messages = str(call.kwargs["messages"])
+        if session_id in previous:
+            assert f"Answer to {previous[session_id]}" in messages
+        else:
+            assert "Answer to" not in messages
+        previous[session_id] = question
+
+
+@pytest.mark.usefixtures("rag_patches")
+def test_query_no_session(test_config, anthropic_mock, make_text_response):
     """Test query without session_id"""
     # Setup response
-    mock_response = MagicMock()
-    mock_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Answer"
-    mock_response.content = [text_block]
+    mock_response = make_text_response("Answer")
 
-    mock_client = MagicMock()
-    mock_client.messages.create.return_value = mock_response
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
+    anthropic_mock.messages.create.return_value = mock_response
 
     # Execute
     rag = RAGSystem(test_config)
@@ -142,291 +184,127 @@ def test_query_no_session(mocker, test_config):
     assert response == "Answer"
 
 
-def test_sources_returned(mocker, test_config):
-    """Test source tracking through tool_manager"""
-    # Setup tool use response
-    tool_use_response = MagicMock()
-    tool_use_response.stop_reason = "tool_use"
-    tool_block = MagicMock()
-    tool_block.type = "tool_use"
-    tool_block.name = "search_course_content"
-    tool_block.id = "tool_123"
-    tool_block.input = {"query": "test"}
-    tool_use_response.content = [tool_block]
-
-    text_response = MagicMock()
-    text_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Answer"
-    text_response.content = [text_block]
-
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = [tool_use_response, text_response]
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-
-    # Mock VectorStore with sources
-    mock_vector_store = MagicMock()
-    search_results = SearchResults(
-        documents=["Content"],
-        metadata=[{"course_title": "Test Course", "lesson_number": 1}],
-        distances=[0.1],
-        error=None,
-    )
-    mock_vector_store.search.return_value = search_results
-    mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson1"
-
-    mocker.patch("rag_system.VectorStore", return_value=mock_vector_store)
-    mocker.patch("rag_system.DocumentProcessor")
-
-    # Execute
-    rag = RAGSystem(test_config)
-    response, sources = rag.query("Test query")
-
-    # Verify sources format
-    assert isinstance(sources, list)
-    if len(sources) > 0:
-        assert "text" in sources[0]
-        assert "link" in sources[0]
-
-
-def test_sources_reset(mocker, test_config):
+def test_sources_reset(
+    rag_patches,
+    mock_vector_store,
+    test_config,
+    anthropic_mock,
+    make_tool_use_response,
+    make_text_response,
+):
     """Test sources cleared between queries"""
     # Setup tool use responses
-    tool_use_response = MagicMock()
-    tool_use_response.stop_reason = "tool_use"
-    tool_block = MagicMock()
-    tool_block.type = "tool_use"
-    tool_block.name = "search_course_content"
-    tool_block.id = "tool_123"
-    tool_block.input = {"query": "test"}
-    tool_use_response.content = [tool_block]
-
-    text_response = MagicMock()
-    text_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Answer"
-    text_response.content = [text_block]
+    tool_use_response = make_tool_use_response(
+        tool_name="search_course_content",
+        tool_id="tool_123",
+        tool_input={"query": "test"},
+    )
 
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = [
+    text_response = make_text_response("Answer")
+
+    anthropic_mock.messages.create.side_effect = [
         tool_use_response,
         text_response,  # First query
         tool_use_response,
         text_response,  # Second query
     ]
 
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-
-    # Mock VectorStore
-    mock_vector_store = MagicMock()
-    search_results = SearchResults(
-        documents=["Content"],
-        metadata=[{"course_title": "Test Course", "lesson_number": 1}],
-        distances=[0.1],
-        error=None,
-    )
-    mock_vector_store.search.return_value = search_results
-    mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson1"
-
-    mocker.patch("rag_system.VectorStore", return_value=mock_vector_store)
-    mocker.patch("rag_system.DocumentProcessor")
+    rag_patches.vector_store.return_value = mock_vector_store
 
     # Execute two queries
     rag = RAGSystem(test_config)
     response1, sources1 = rag.query("First query")
     response2, sources2 = rag.query("Second query")
 
-    # Verify sources reset (tool_manager.reset_sources() called)
-    # Both queries should have fresh sources, not accumulated
-    assert isinstance(sources1, list)
-    assert isinstance(sources2, list)
-
-
-def test_session_updated_after_query(mocker, test_config):
-    """Test conversation saved to session"""
-    # Setup response
-    mock_response = MagicMock()
-    mock_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Answer to question"
-    mock_response.content = [text_block]
-
-    mock_client = MagicMock()
-    mock_client.messages.create.return_value = mock_response
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
+    # Verify each query reports only its own sources, not accumulated ones
+    assert sources1 == SAMPLE_SOURCES
+    assert sources2 == sources1
 
-    # Execute
-    rag = RAGSystem(test_config)
-    query_text = "What is the answer?"
-    response, _ = rag.query(query_text, session_id="test_session")
-
-    # Verify session updated
-    history = rag.session_manager.get_conversation_history("test_session")
-    assert history is not None
-    assert "What is the answer?" in history
-    assert "Answer to question" in history
-
-
-def test_multiple_queries_same_session(mocker, test_config):
-    """Test history accumulates across queries"""
-    # Setup responses
-    mock_response1 = MagicMock()
-    mock_response1.stop_reason = "end_turn"
-    text_block1 = MagicMock()
-    text_block1.text = "First answer"
-    mock_response1.content = [text_block1]
-
-    mock_response2 = MagicMock()
-    mock_response2.stop_reason = "end_turn"
-    text_block2 = MagicMock()
-    text_block2.text = "Second answer"
-    mock_response2.content = [text_block2]
-
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = [mock_response1, mock_response2]
 
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
+@pytest.mark.usefixtures("rag_patches")
+def test_tool_manager_registration(test_config):
+    """Test tools properly registered"""
 
     # Execute
     rag = RAGSystem(test_config)
-    rag.query("First question", session_id="test_session")
-    rag.query("Second question", session_id="test_session")
-
-    # Verify history includes both exchanges
-    history = rag.session_manager.get_conversation_history("test_session")
-    assert "First question" in history
-    assert "First answer" in history
-    assert "Second question" in history
-    assert "Second answer" in history
-
-
-def test_query_with_empty_results(mocker, test_config):
-    """Test search finds nothing"""
-    # Setup tool use response
-    tool_use_response = MagicMock()
-    tool_use_response.stop_reason = "tool_use"
-    tool_block = MagicMock()
-    tool_block.type = "tool_use"
-    tool_block.name = "search_course_content"
-    tool_block.id = "tool_123"
-    tool_block.input = {"query": "nonexistent topic"}
-    tool_use_response.content = [tool_block]
-
-    text_response = MagicMock()
-    text_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "I couldn't find information about that topic."
-    text_response.content = [text_block]
 
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = [tool_use_response, text_response]
+    # Verify tools registered
+    tool_defs = rag.tool_manager.get_tool_definitions()
+    assert len(tool_defs) == 3
 
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
+    # Verify CourseSearchTool registered
+    tool_names = [tool["name"] for tool in tool_defs]
+    assert "search_course_content" in tool_names
+    assert "get_course_outline" in tool_names
+    assert "batch_tool" in tool_names
 
-    # Mock VectorStore with empty results
-    mock_vector_store = MagicMock()
-    empty_results = SearchResults(documents=[], metadata=[], distances=[], error=None)
-    mock_vector_store.search.return_value = empty_results
 
-    mocker.patch("rag_system.VectorStore", return_value=mock_vector_store)
-    mocker.patch("rag_system.DocumentProcessor")
+@pytest.mark.usefixtures("rag_patches")
+def test_tool_definitions_cached_until_registration(test_config):
+    """Test tool definitions are reused across queries and rebuilt on register"""
 
     # Execute
     rag = RAGSystem(test_config)
-    response, sources = rag.query("Nonexistent topic")
-
-    # Verify Claude handles "No relevant content found" message
-    assert response is not None
+    first = rag.tool_manager.get_tool_definitions()
 
+    # Verify same list returned until a tool is registered
+    assert rag.tool_manager.get_tool_definitions() is first
+    rag.tool_manager.register_tool(rag.outline_tool)
+    assert rag.tool_manager.get_tool_definitions() is not first
 
-def test_query_with_search_error(mocker, test_config):
-    """Test VectorStore error propagation"""
-    # Setup tool use response
-    tool_use_response = MagicMock()
-    tool_use_response.stop_reason = "tool_use"
-    tool_block = MagicMock()
-    tool_block.type = "tool_use"
-    tool_block.name = "search_course_content"
-    tool_block.id = "tool_123"
-    tool_block.input = {"query": "test"}
-    tool_use_response.content = [tool_block]
-
-    text_response = MagicMock()
-    text_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "There was an error accessing the course materials."
-    text_response.content = [text_block]
-
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = [tool_use_response, text_response]
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
 
-    # Mock VectorStore with error
+async def test_concurrent_queries_keep_sources_separate(
+    mocker, rag_patches, test_config
+):
+    """Test sources from one in-flight query never appear in another"""
     mock_vector_store = MagicMock()
-    error_results = SearchResults(
-        documents=[], metadata=[], distances=[], error="Database connection failed"
+    mock_vector_store.search.side_effect = lambda query, **_kwargs: SearchResults(
+        documents=["Content"],
+        metadata=[{"course_title": query, "lesson_number": 1}],
+        distances=[0.1],
     )
-    mock_vector_store.search.return_value = error_results
+    mock_vector_store.get_lesson_links.side_effect = dict.fromkeys
+    rag_patches.vector_store.return_value = mock_vector_store
 
-    mocker.patch("rag_system.VectorStore", return_value=mock_vector_store)
-    mocker.patch("rag_system.DocumentProcessor")
-
-    # Execute
     rag = RAGSystem(test_config)
-    response, sources = rag.query("Test query")
-
-    # Verify error handled gracefully
-    assert response is not None
-
 
-def test_tool_manager_registration(mocker, test_config):
-    """Test tools properly registered"""
-    mocker.patch("anthropic.Anthropic")
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
+    async def generate_response(query, tool_manager, context, **_kwargs):
+        course = "MCP" if "MCP" in query else "Chroma"
+        tool_manager.execute_tool(
+            "search_course_content", context=context, query=course
+        )
+        # Let the other query search before this one finishes
+        await asyncio.sleep(0)
+        return f"{course} answer"
+
+    mocker.patch.object(
+        rag.async_ai_generator, "generate_response", side_effect=generate_response
+    )
 
-    # Execute
-    rag = RAGSystem(test_config)
+    # Execute both queries at once
+    (_, mcp_sources), (_, chroma_sources) = await asyncio.gather(
+        rag.aquery("What is MCP?"), rag.aquery("What is Chroma?")
+    )
 
-    # Verify tools registered
-    tool_defs = rag.tool_manager.get_tool_definitions()
-    assert len(tool_defs) == 2
-
-    # Verify CourseSearchTool registered
-    tool_names = [tool["name"] for tool in tool_defs]
-    assert "search_course_content" in tool_names
-    assert "get_course_outline" in tool_names
+    # Verify each query only reports its own search
+    assert mcp_sources == [{"text": "MCP - Lesson 1", "link": None}]
+    assert chroma_sources == [{"text": "Chroma - Lesson 1", "link": None}]
 
 
-def test_query_uses_outline_tool(mocker, test_config):
+def test_query_uses_outline_tool(
+    rag_patches, test_config, anthropic_mock, make_tool_use_response, make_text_response
+):
     """Test structural query uses get_course_outline"""
     # Setup tool use response for outline tool
-    tool_use_response = MagicMock()
-    tool_use_response.stop_reason = "tool_use"
-    tool_block = MagicMock()
-    tool_block.type = "tool_use"
-    tool_block.name = "get_course_outline"
-    tool_block.id = "tool_123"
-    tool_block.input = {"course_name": "Prompt Engineering"}
-    tool_use_response.content = [tool_block]
-
-    text_response = MagicMock()
-    text_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "The course has 5 lessons..."
-    text_response.content = [text_block]
+    tool_use_response = make_tool_use_response(
+        tool_name="get_course_outline",
+        tool_id="tool_123",
+        tool_input={"course_name": "Prompt Engineering"},
+    )
 
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = [tool_use_response, text_response]
+    text_response = make_text_response("The course has 5 lessons...")
 
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
+    anthropic_mock.messages.create.side_effect = [tool_use_response, text_response]
 
     # Mock VectorStore with course catalog
     mock_vector_store = MagicMock()
@@ -444,8 +322,7 @@ def test_query_uses_outline_tool(mocker, test_config):
         ]
     }
 
-    mocker.patch("rag_system.VectorStore", return_value=mock_vector_store)
-    mocker.patch("rag_system.DocumentProcessor")
+    rag_patches.vector_store.return_value = mock_vector_store
 
     # Execute
     rag = RAGSystem(test_config)
@@ -455,78 +332,28 @@ def test_query_uses_outline_tool(mocker, test_config):
     assert response is not None
 
 
-def test_max_history_limit(mocker, test_config):
-    """Test history truncation at MAX_HISTORY"""
-    # Setup responses
-    mock_responses = []
-    for i in range(5):
-        mock_response = MagicMock()
-        mock_response.stop_reason = "end_turn"
-        text_block = MagicMock()
-        text_block.text = f"Answer {i}"
-        mock_response.content = [text_block]
-        mock_responses.append(mock_response)
+@pytest.mark.usefixtures("rag_patches")
+def test_history_trimmed_in_batches(test_config):
+    """Test history grows into the buffer, then drops buffered exchanges at once"""
+    test_config.HISTORY_BUFFER = 2
 
-    mock_client = MagicMock()
-    mock_client.messages.create.side_effect = mock_responses
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
-
-    # Execute multiple queries
-    rag = RAGSystem(test_config)
-    session_id = "test_session"
-
-    for i in range(5):
-        rag.query(f"Question {i}", session_id=session_id)
-
-    # Verify only MAX_HISTORY (2) exchanges kept
-    history = rag.session_manager.get_conversation_history(session_id)
-    # Should only have last 2 exchanges (4 messages total)
-    # Count how many "Question" entries in history
-    question_count = history.count("Question")
-    assert question_count == 2  # MAX_HISTORY = 2
-
-
-def test_concurrent_sessions(mocker, test_config):
-    """Test multiple sessions are isolated"""
-    # Setup response
-    mock_response = MagicMock()
-    mock_response.stop_reason = "end_turn"
-    text_block = MagicMock()
-    text_block.text = "Answer"
-    mock_response.content = [text_block]
-
-    mock_client = MagicMock()
-    mock_client.messages.create.return_value = mock_response
-
-    mocker.patch("anthropic.Anthropic", return_value=mock_client)
-    mocker.patch("rag_system.VectorStore")
-    mocker.patch("rag_system.DocumentProcessor")
-
-    # Execute
     rag = RAGSystem(test_config)
+    session_manager = rag.session_manager
 
-    # Create two separate sessions
-    rag.query("Question for session 1", session_id="session_1")
-    rag.query("Question for session 2", session_id="session_2")
-
-    # Verify session isolation
-    history1 = rag.session_manager.get_conversation_history("session_1")
-    history2 = rag.session_manager.get_conversation_history("session_2")
+    # Execute: MAX_HISTORY + HISTORY_BUFFER exchanges fit without trimming
+    for i in range(4):
+        session_manager.add_exchange("batch", f"Question {i}", f"Answer {i}")
+    assert session_manager.get_conversation_history("batch").count("Question") == 4
 
-    assert "Question for session 1" in history1
-    assert "Question for session 1" not in history2
+    # One more exchange trims back to MAX_HISTORY in a single step
+    session_manager.add_exchange("batch", "Question 4", "Answer 4")
+    history = session_manager.get_conversation_history("batch")
+    assert history.count("Question") == 2
+    assert history.startswith("User: Question 3")
 
-    assert "Question for session 2" in history2
-    assert "Question for session 2" not in history1
 
-
-def test_integration_with_document_processing(mocker, test_config):
+def test_integration_with_document_processing(rag_patches, test_config):
     """Test full pipeline from document to query"""
-    mocker.patch("anthropic.Anthropic")
-    mocker.patch("rag_system.VectorStore")
 
     # Mock DocumentProcessor
     mock_processor = MagicMock()
@@ -542,7 +369,7 @@ def test_integration_with_document_processing(mocker, test_config):
     )
     mock_processor.process_course_document.return_value = (mock_course, [])
 
-    mocker.patch("rag_system.DocumentProcessor", return_value=mock_processor)
+    rag_patches.document_processor.return_value = mock_processor
 
     # Execute
     rag = RAGSystem(test_config)
@@ -552,3 +379,349 @@ def test_integration_with_document_processing(mocker, test_config):
     assert rag.vector_store is not None
     assert rag.ai_generator is not None
     assert rag.tool_manager is not None
+
+
+@pytest.mark.usefixtures("rag_patches")
+def test_sync_generator_built_on_first_query(mocker, test_config):
+    """Test the blocking generator is only created once query() needs it"""
+    generator_class = mocker.patch("rag_system.AIGenerator")
+    generator_class.return_value.generate_response.return_value = "Answer"
+
+    rag = RAGSystem(test_config)
+    generator_class.assert_not_called()
+
+    # Execute
+    rag.query("Question")
+    rag.query("Another question")
+
+    # Verify one generator serves every query
+    generator_class.assert_called_once_with(
+        test_config.ANTHROPIC_API_KEY, test_config.ANTHROPIC_MODEL
+    )
+
+
+async def test_aquery_uses_async_generator(
+    rag_patches, test_config, make_text_response
+):
+    """Test async query path awaits Claude and records the exchange"""
+    mock_response = make_text_response("Async answer")
+
+    mock_client = MagicMock()
+    mock_client.messages.create = AsyncMock(return_value=mock_response)
+
+    rag_patches.async_anthropic.return_value = mock_client
+
+    # Execute
+    rag = RAGSystem(test_config)
+    response, sources = await rag.aquery("Async question", session_id="async_session")
+
+    # Verify response and session history
+    assert response == "Async answer"
+    assert sources == []
+    mock_client.messages.create.assert_awaited_once()
+    history = rag.session_manager.get_conversation_history("async_session")
+    assert "Async question" in history
+    assert "Async answer" in history
+
+
+@pytest.mark.usefixtures("rag_patches")
+async def test_astream_yields_text_then_sources(mocker, test_config):
+    """Test streamed queries yield chunks, then sources, and record the exchange"""
+
+    async def astream_response(**_kwargs):
+        yield {"type": "text", "text": "Streamed "}
+        yield {"type": "text", "text": "answer"}
+
+    rag = RAGSystem(test_config)
+    mocker.patch.object(
+        rag.async_ai_generator, "astream_response", side_effect=astream_response
+    )
+
+    # Execute
+    events = [event async for event in rag.astream("Question", session_id="s1")]
+
+    # Verify events and session history
+    assert events == [
+        {"type": "text", "text": "Streamed "},
+        {"type": "text", "text": "answer"},
+        {"type": "sources", "sources": []},
+    ]
+    history = rag.session_manager.get_conversation_history("s1")
+    assert "Streamed answer" in history
+
+
+@pytest.mark.usefixtures("rag_patches")
+async def test_astream_records_only_final_round_text(mocker, test_config):
+    """Test a tool-use preamble is retracted and left out of the recorded answer"""
+
+    async def astream_response(**_kwargs):
+        yield {"type": "text", "text": "Let me check. "}
+        yield {"type": "tool_round"}
+        yield {"type": "text", "text": "Final answer"}
+
+    test_config.RESPONSE_CACHE_SIZE = 8
+    rag = RAGSystem(test_config)
+    mocker.patch.object(
+        rag.async_ai_generator, "astream_response", side_effect=astream_response
+    )
+
+    # Execute
+    events = [event async for event in rag.astream("Question", session_id="s1")]
+
+    # Verify the client is told to drop the preamble and only the answer is stored
+    assert [event["type"] for event in events] == [
+        "text",
+        "tool_round",
+        "text",
+        "sources",
+    ]
+    history = rag.session_manager.get_conversation_history("s1")
+    assert "Final answer" in history
+    assert "Let me check" not in history
+    assert list(rag.response_cache.values()) == [("Final answer", [])]
+
+
+@pytest.mark.usefixtures("rag_patches")
+async def test_abatch_query_records_each_exchange(mocker, test_config):
+    """Test batched queries are answered together and recorded per session"""
+
+    rag = RAGSystem(test_config)
+    generate_batch = mocker.patch.object(
+        rag.async_ai_generator,
+        "generate_batch",
+        AsyncMock(return_value=["Answer A", "Answer B"]),
+    )
+
+    # Execute
+    results = await rag.abatch_query([("Question A", "a"), ("Question B", "b")])
+
+    # Verify one batch call and both exchanges recorded
+    assert results == [("Answer A", []), ("Answer B", [])]
+    generate_batch.assert_awaited_once()
+    prompts = [prompt for prompt, _history in generate_batch.call_args.args[0]]
+    assert "Question A" in prompts[0]
+    assert "Question B" in prompts[1]
+    assert "Answer B" in rag.session_manager.get_conversation_history("b")
+
+
+@pytest.mark.usefixtures("rag_patches")
+async def test_abatch_query_skips_failed_queries(mocker, test_config):
+    """Test a failed batched query is returned as its error and not recorded"""
+    rag = RAGSystem(test_config)
+    error = TimeoutError("Batch did not end")
+    mocker.patch.object(
+        rag.async_ai_generator,
+        "generate_batch",
+        AsyncMock(return_value=["Answer A", error]),
+    )
+
+    results = await rag.abatch_query([("Question A", "a"), ("Question B", "b")])
+
+    assert results == [("Answer A", []), error]
+    assert rag.session_manager.get_conversation_history("b") is None
+
+
+def test_shared_http_client_passed_to_async_anthropic(rag_patches, test_config):
+    """Test the injected connection pool reaches the async Anthropic client"""
+    mock_async_anthropic = rag_patches.async_anthropic
+    http_client = MagicMock()
+
+    # Execute
+    RAGSystem(test_config, http_client=http_client)
+
+    # Verify
+    assert mock_async_anthropic.call_args.kwargs["http_client"] is http_client
+
+
+@pytest.mark.usefixtures("rag_patches")
+def test_ingest_folder_tracks_status(mocker, test_config):
+    """Test ingestion status moves to complete with course counts"""
+
+    rag = RAGSystem(test_config)
+    assert rag.ingestion_status["state"] == "idle"
+    mocker.patch.object(rag, "add_course_folder", return_value=(2, 30))
+
+    # Execute
+    rag.ingest_folder("../docs")
+
+    # Verify
+    rag.add_course_folder.assert_called_once_with("../docs", clear_existing=False)
+    assert rag.ingestion_status == {
+        "state": "complete",
+        "courses": 2,
+        "chunks": 30,
+        "error": None,
+    }
+
+
+@pytest.mark.usefixtures("rag_patches")
+def test_ingest_folder_records_failure(mocker, test_config):
+    """Test ingestion errors are recorded instead of raised"""
+
+    rag = RAGSystem(test_config)
+    mocker.patch.object(
+        rag, "add_course_folder", side_effect=RuntimeError("Embedding failed")
+    )
+
+    # Execute
+    rag.ingest_folder("../docs")
+
+    # Verify
+    assert rag.ingestion_status["state"] == "failed"
+    assert rag.ingestion_status["error"] == "Embedding failed"
+
+
+def test_semantic_cache_serves_repeated_query(
+    rag_patches, test_config, anthropic_mock, make_text_response
+):
+    """Test a repeated question skips Claude but still updates the session"""
+    mock_response = make_text_response("Cached answer")
+
+    anthropic_mock.messages.create.return_value = mock_response
+
+    mock_vector_store = MagicMock()
+    mock_vector_store.embedding_function.return_value = [[0.6, 0.8]]
+    rag_patches.vector_store.return_value = mock_vector_store
+    test_config.SEMANTIC_CACHE_SIZE = 8
+
+    # Execute the same question twice without history
+    rag = RAGSystem(test_config)
+    first = rag.query("What is MCP?")
+    second = rag.query("What is MCP?", session_id="cached_session")
+
+    # Verify one API call and the cached exchange recorded
+    assert anthropic_mock.messages.create.call_count == 1
+    assert second == first
+    history = rag.session_manager.get_conversation_history("cached_session")
+    assert "Cached answer" in history
+
+
+def test_response_cache_serves_exact_repeat(
+    rag_patches, test_config, anthropic_mock, make_text_response
+):
+    """Test an exact repeat skips both Claude and the query embedding"""
+    mock_response = make_text_response("Cached answer")
+
+    anthropic_mock.messages.create.return_value = mock_response
+
+    mock_vector_store = MagicMock()
+    rag_patches.vector_store.return_value = mock_vector_store
+    test_config.RESPONSE_CACHE_SIZE = 8
+
+    # Execute the same question twice, then once with history
+    rag = RAGSystem(test_config)
+    first = rag.query("What is MCP?")
+    second = rag.query("What is MCP?", session_id="cached_session")
+    rag.query("What is MCP?", session_id="cached_session")
+
+    # Verify the repeat was cached but the new history missed
+    assert second == first
+    assert anthropic_mock.messages.create.call_count == 2
+    assert "Cached answer" in rag.session_manager.get_conversation_history(
+        "cached_session"
+    )
+    mock_vector_store.embedding_function.assert_not_called()
+
+
+@pytest.mark.usefixtures("rag_patches")
+def test_response_cache_skips_tool_failure_answers(mocker, test_config):
+    """Test an answer explaining a tool failure is not replayed from the cache"""
+    test_config.RESPONSE_CACHE_SIZE = 8
+    rag = RAGSystem(test_config)
+
+    def generate_response(context, **_kwargs):
+        context.failed = True
+        return "Search is unavailable right now"
+
+    generate = mocker.patch.object(
+        rag.ai_generator, "generate_response", side_effect=generate_response
+    )
+
+    # Execute the same question twice
+    rag.query("What is MCP?")
+    rag.query("What is MCP?")
+
+    # Verify both were generated and nothing was cached
+    assert generate.call_count == 2
+    assert len(rag.response_cache) == 0
+
+
+def test_semantic_cache_skips_tool_failure_answers(rag_patches, mocker, test_config):
+    """Test a tool-failure answer is not served to near-duplicate questions"""
+    mock_vector_store = MagicMock()
+    mock_vector_store.embedding_function.return_value = [[0.6, 0.8]]
+    rag_patches.vector_store.return_value = mock_vector_store
+    test_config.SEMANTIC_CACHE_SIZE = 8
+    rag = RAGSystem(test_config)
+
+    def generate_response(context, **_kwargs):
+        context.failed = True
+        return "Search is unavailable right now"
+
+    generate = mocker.patch.object(
+        rag.ai_generator, "generate_response", side_effect=generate_response
+    )
+
+    # Execute the same question twice
+    rag.query("What is MCP?")
+    rag.query("What is MCP?")
+
+    # Verify the second question was generated again
+    assert generate.call_count == 2
+
+
+def test_caches_skip_partly_failed_batch_answers(
+    rag_patches,
+    mock_vector_store,
+    sample_search_results,
+    error_search_results,
+    test_config,
+    anthropic_mock,
+    make_tool_use_response,
+    make_text_response,
+):
+    """Test one failed search inside a batch_tool call keeps the answer uncached"""
+    anthropic_mock.messages.create.side_effect = [
+        make_tool_use_response(
+            tool_name="batch_tool",
+            tool_input={
+                "invocations": [
+                    {"name": "search_course_content", "arguments": {"query": "MCP"}},
+                    {"name": "search_course_content", "arguments": {"query": "RAG"}},
+                ]
+            },
+        ),
+        make_text_response("Only MCP could be searched"),
+    ]
+    mock_vector_store.search.side_effect = lambda query, **_kwargs: (
+        error_search_results if query == "RAG" else sample_search_results
+    )
+    mock_vector_store.embedding_function.return_value = [[0.6, 0.8]]
+    rag_patches.vector_store.return_value = mock_vector_store
+    test_config.RESPONSE_CACHE_SIZE = 8
+    test_config.SEMANTIC_CACHE_SIZE = 8
+
+    # Execute
+    rag = RAGSystem(test_config)
+    response, _ = rag.query("Compare MCP and RAG")
+
+    # Verify the answer was given but neither cache kept it
+    assert response == "Only MCP could be searched"
+    assert mock_vector_store.search.call_count == 2
+    assert len(rag.response_cache) == 0
+    assert len(rag.semantic_cache) == 0
+
+
+@pytest.mark.usefixtures("rag_patches")
+def test_ingest_clears_response_cache(mocker, test_config):
+    """Test ingesting new courses drops answers given for the old catalog"""
+    test_config.RESPONSE_CACHE_SIZE = 8
+    rag = RAGSystem(test_config)
+    rag.response_cache["key"] = ("Stale answer", [])
+    mocker.patch.object(rag, "add_course_folder", return_value=(1, 10))
+
+    # Execute
+    rag.ingest_folder("../docs")
+
+    # Verify
+    assert len(rag.response_cache) == 0
@@ -0,0 +1,91 @@
+"""
+Tests for SemanticCache lookups and eviction
+Tests cover: similarity hits and misses, history matching, LRU eviction, clearing
+"""
+
+import numpy as np
+import pytest
+from semantic_cache import SemanticCache
+
+# Fixed embeddings so similarity between test queries is known exactly
+EMBEDDINGS = {
+    "What is MCP?": [1.0, 0.0, 0.0],
+    "what is mcp": [0.99, 0.1, 0.0],  # cosine ~0.995 with "What is MCP?"
+    "How do prompts work?": [0.0, 1.0, 0.0],
+    "Explain tool use": [0.0, 0.0, 1.0],
+}
+
+
+def fake_embedding_function(texts):
+    """Stand-in for the sentence transformer embedding function"""
+    return [np.array(EMBEDDINGS[text]) for text in texts]
+
+
+@pytest.fixture
+def cache():
+    """Small semantic cache over the fixed embeddings"""
+    return SemanticCache(fake_embedding_function, maxsize=2, threshold=0.95)
+
+
+def store(cache, query, answer, history=None):
+    """Embed and store an answer"""
+    cache.store(cache.embed(query), history, answer, [{"text": query, "link": None}])
+
+
+def test_embed_returns_unit_vector(cache):
+    """Test embeddings are normalized so dot products are cosine similarities"""
+    assert np.linalg.norm(cache.embed("what is mcp")) == pytest.approx(1.0)
+
+
+def test_similar_query_hits(cache):
+    """Test a near-duplicate question returns the stored answer and sources"""
+    store(cache, "What is MCP?", "MCP answer")
+
+    answer, sources = cache.lookup(cache.embed("what is mcp"), None)
+
+    assert answer == "MCP answer"
+    assert sources == [{"text": "What is MCP?", "link": None}]
+
+
+def test_dissimilar_query_misses(cache):
+    """Test a different question is not served from the cache"""
+    store(cache, "What is MCP?", "MCP answer")
+
+    assert cache.lookup(cache.embed("How do prompts work?"), None) is None
+
+
+def test_history_must_match(cache):
+    """Test answers are only reused for the same conversation history"""
+    store(cache, "What is MCP?", "MCP answer", history="User: Hi\nAssistant: Hello")
+
+    assert cache.lookup(cache.embed("What is MCP?"), None) is None
+    hit = cache.lookup(cache.embed("What is MCP?"), "User: Hi\nAssistant: Hello")
+    assert hit[0] == "MCP answer"
+
+
+def test_least_recently_used_evicted(cache):
+    """Test a full cache evicts the least recently used answer and reuses its row"""
+    store(cache, "What is MCP?", "MCP answer")
+    store(cache, "How do prompts work?", "Prompt answer")
+
+    # Touch the first entry so the second becomes least recently used
+    cache.lookup(cache.embed("What is MCP?"), None)
+    store(cache, "Explain tool use", "Tool answer")
+
+    assert len(cache) == 2
+    assert cache.lookup(cache.embed("How do prompts work?"), None) is None
+    assert cache.lookup(cache.embed("What is MCP?"), None)[0] == "MCP answer"
+    assert cache.lookup(cache.embed("Explain tool use"), None)[0] == "Tool answer"
+
+
+def test_clear_removes_all_answers(cache):
+    """Test clearing empties the cache and leaves it usable"""
+    store(cache, "What is MCP?", "MCP answer")
+    store(cache, "How do prompts work?", "Prompt answer")
+
+    cache.clear()
+
+    assert len(cache) == 0
+    assert cache.lookup(cache.embed("What is MCP?"), None) is None
+    store(cache, "Explain tool use", "Tool answer")
+    assert cache.lookup(cache.embed("Explain tool use"), None)[0] == "Tool answer"
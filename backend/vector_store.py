@@ -1,10 +1,14 @@
+import logging
 from dataclasses import dataclass
 from typing import Any
 
 import chromadb
+import orjson
 from chromadb.config import Settings
 from models import Course, CourseChunk
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class SearchResults:
@@ -47,6 +51,8 @@ class VectorStore:
         self, chroma_path: str, embedding_model: str, max_results: int = 5
     ) -> None:
         self.max_results = max_results
+        # Bumped whenever the course catalog changes so readers can drop caches
+        self.catalog_version = 0
         # Initialize ChromaDB client
         self.client = chromadb.PersistentClient(
             path=chroma_path, settings=Settings(anonymized_telemetry=False)
@@ -123,7 +129,7 @@ class VectorStore:
                 # Return the title (which is now the ID)
                 return results["metadatas"][0][0]["title"]
         except Exception as e:
-            print(f"Error resolving course name: {e}")
+            logger.error("Error resolving course name: %s", e)
 
         return None
 
@@ -150,8 +156,6 @@ class VectorStore:
 
     def add_course_metadata(self, course: Course) -> None:
         """Add course information to the catalog for semantic search"""
-        import json
-
         course_text = course.title
 
         # Build lessons metadata and serialize as JSON string
@@ -172,14 +176,15 @@ class VectorStore:
                     "title": course.title,
                     "instructor": course.instructor,
                     "course_link": course.course_link,
-                    "lessons_json": json.dumps(
+                    "lessons_json": orjson.dumps(
                         lessons_metadata
-                    ),  # Serialize as JSON string
+                    ).decode(),  # Serialize as JSON string
                     "lesson_count": len(course.lessons),
                 }
             ],
             ids=[course.title],
         )
+        self.catalog_version += 1
 
     def add_course_content(self, chunks: list[CourseChunk]) -> None:
         """Add course content chunks to the vector store"""
@@ -212,7 +217,8 @@ class VectorStore:
             self.course_catalog = self._create_collection("course_catalog")
             self.course_content = self._create_collection("course_content")
         except Exception as e:
-            print(f"Error clearing data: {e}")
+            logger.error("Error clearing data: %s", e)
+        self.catalog_version += 1
 
     def get_existing_course_titles(self) -> list[str]:
         """Get all existing course titles from the vector store"""
@@ -223,7 +229,7 @@ class VectorStore:
                 return results["ids"]
             return []
         except Exception as e:
-            print(f"Error getting existing course titles: {e}")
+            logger.error("Error getting existing course titles: %s", e)
             return []
 
     def get_course_count(self) -> int:
@@ -234,13 +240,11 @@ class VectorStore:
                 return len(results["ids"])
             return 0
         except Exception as e:
-            print(f"Error getting course count: {e}")
+            logger.error("Error getting course count: %s", e)
             return 0
 
     def get_all_courses_metadata(self) -> list[dict[str, Any]]:
         """Get metadata for all courses in the vector store"""
-        import json
-
         try:
             results = self.course_catalog.get()
             if results and "metadatas" in results:
@@ -249,7 +253,9 @@ class VectorStore:
                 for metadata in results["metadatas"]:
                     course_meta = metadata.copy()
                     if "lessons_json" in course_meta:
-                        course_meta["lessons"] = json.loads(course_meta["lessons_json"])
+                        course_meta["lessons"] = orjson.loads(
+                            course_meta["lessons_json"]
+                        )
                         del course_meta[
                             "lessons_json"
                         ]  # Remove the JSON string version
@@ -257,7 +263,7 @@ class VectorStore:
                 return parsed_metadata
             return []
         except Exception as e:
-            print(f"Error getting courses metadata: {e}")
+            logger.error("Error getting courses metadata: %s", e)
             return []
 
     def get_course_link(self, course_title: str) -> str | None:
@@ -270,13 +276,11 @@ class VectorStore:
                 return metadata.get("course_link")
             return None
         except Exception as e:
-            print(f"Error getting course link: {e}")
+            logger.error("Error getting course link: %s", e)
             return None
 
     def get_lesson_link(self, course_title: str, lesson_number: int) -> str | None:
         """Get lesson link for a given course title and lesson number"""
-        import json
-
         try:
             # Get course by ID (title is the ID)
             results = self.course_catalog.get(ids=[course_title])
@@ -284,11 +288,42 @@ class VectorStore:
                 metadata = results["metadatas"][0]
                 lessons_json = metadata.get("lessons_json")
                 if lessons_json:
-                    lessons = json.loads(lessons_json)
+                    lessons = orjson.loads(lessons_json)
                     # Find the lesson with matching number
                     for lesson in lessons:
                         if lesson.get("lesson_number") == lesson_number:
                             return lesson.get("lesson_link")
             return None
         except Exception as e:
-            print(f"Error getting lesson link: {e}")
+            logger.error("Error getting lesson link: %s", e)
+
+    def get_lesson_links(
+        self, lessons: list[tuple[str, int]]
+    ) -> dict[tuple[str, int], str | None]:
+        """
+        Get lesson links for many (course title, lesson number) pairs at once.
+
+        Args:
+            lessons: Course title and lesson number pairs to look up
+
+        Returns:
+            Mapping of each found pair to its lesson link
+        """
+        course_titles = list(dict.fromkeys(title for title, _ in lessons))
+        if not course_titles:
+            return {}
+
+        try:
+            # One catalog round-trip for every course referenced (title is the ID)
+            results = self.course_catalog.get(ids=course_titles)
+            links = {}
+            for metadata in results.get("metadatas") or []:
+                lessons_json = metadata.get("lessons_json")
+                if lessons_json:
+                    for lesson in orjson.loads(lessons_json):
+                        key = (metadata.get("title"), lesson.get("lesson_number"))
+                        links[key] = lesson.get("lesson_link")
+            return links
+        except Exception as e:
+            logger.error("Error getting lesson links: %s", e)
+            return {}
@@ -104,7 +104,7 @@ async function sendMessage() {
     chatMessages.scrollTop = chatMessages.scrollHeight;
 
     try {
-        const response = await fetch(`${API_URL}/query`, {
+        const response = await fetch(`${API_URL}/query/stream`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -117,16 +117,36 @@ async function sendMessage() {
 
         if (!response.ok) throw new Error('Query failed');
 
-        const data = await response.json();
-        
-        // Update session ID if new
-        if (!currentSessionId) {
-            currentSessionId = data.session_id;
-        }
+        // Render the answer as server-sent events arrive
+        let answer = '';
+        let sources = null;
+        const contentDiv = loadingMessage.querySelector('.message-content');
+        const loadingHtml = contentDiv.innerHTML;
+
+        await readEvents(response, (event) => {
+            if (event.type === 'text') {
+                // Partial answer replaces the loading dots as it grows
+                answer += event.text;
+                contentDiv.innerHTML = marked.parse(answer);
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            } else if (event.type === 'tool_round') {
+                // Text before a tool call is not the answer; show the dots
+                // again until the next round's text arrives
+                answer = '';
+                contentDiv.innerHTML = loadingHtml;
+            } else if (event.type === 'sources') {
+                sources = event.sources;
+            } else if (event.type === 'error') {
+                throw new Error(event.detail);
+            } else if (event.type === 'done' && !currentSessionId) {
+                // Update session ID if new
+                currentSessionId = event.session_id;
+            }
+        });
 
-        // Replace loading message with response
+        // Replace the streamed message with the finished answer and sources
         loadingMessage.remove();
-        addMessage(data.answer, 'assistant', data.sources);
+        addMessage(answer, 'assistant', sources);
 
     } catch (error) {
         // Replace loading message with error
@@ -139,6 +159,28 @@ async function sendMessage() {
     }
 }
 
+async function readEvents(response, onEvent) {
+    // Parse a text/event-stream body, calling onEvent with each JSON payload
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const line = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            if (line.startsWith('data: ')) {
+                onEvent(JSON.parse(line.slice(6)));
+            }
+        }
+    }
+}
+
 function createLoadingMessage() {
     const messageDiv = document.createElement('div');
     messageDiv.className = 'message assistant';